@@ -0,0 +1,127 @@
+"""قياس كلفة الذاكرة لكل مستأجر في multi_tenant.py مقارنة ببوت في عملية مستقلة.
+
+يشغّل كل قياس في عملية فرعية نظيفة: عملية بوت واحد عبر main مباشرة (خط الأساس لكلفة عملية لكل بوت)،
+ثم عمليات تحمل N مستأجراً بناقل Bot وهمي مشترك. لكل مستأجر قاعدة بيانات مزروعة ومعالجات مسجلة
+وذاكرات مسخنة وبعض التحديثات المعالجة، ثم تُقرأ ذاكرة العملية (RSS):
+
+    python bench_tenants.py --tenants 1,10,100,300 --users 50 --output tenants.json
+"""
+import os
+import gc
+import sys
+import json
+import asyncio
+import logging
+import argparse
+import warnings
+import subprocess
+import tempfile
+
+from telegram import Update
+from telegram.ext import Application
+from telegram.warnings import PTBUserWarning
+
+import bench_updates
+import main
+import multi_tenant
+
+
+async def _prepare_bot(module, application, users):
+    """تهيئة البوت وتسخينه ثم معالجة جولة تحديثات اصطناعية كي تمتلئ حالته كما في التشغيل الفعلي."""
+    await application.initialize()
+    await module.warm_caches(application)
+    for _, data in bench_updates.synthetic_updates(users, 1):
+        await application.process_update(Update.de_json(data, application.bot))
+    while module._pending_notifications:
+        await asyncio.sleep(0.05)
+
+
+async def measure_single(workdir, users):
+    main.NOTIFY_COALESCE_WINDOW = 0
+    bench_updates.seed_database(os.path.join(workdir, 'single.db'), users)
+    application = Application.builder().token(main.TOKEN).request(bench_updates.FakeBotRequest()).updater(None).build()
+    main.register_handlers(application)
+    await _prepare_bot(main, application, users)
+    gc.collect()
+    return {'rss_bytes': main._process_rss()}
+
+
+async def measure_multi(workdir, tenants, users):
+    gc.collect()
+    rss_before = main._process_rss()
+    request = multi_tenant.SharedRequest(bench_updates.FakeBotRequest())
+
+    applications = []
+    for index in range(tenants):
+        entry = {'id': f'bench{index}', 'BOT_TOKEN': f'{index + 1}:bench-token',
+                 'ADMIN_ID': bench_updates.BENCH_ADMIN_ID, 'NOTIFY_COALESCE_WINDOW': 0}
+        module = multi_tenant.load_tenant(entry, workdir)
+        bench_updates.seed_database(module.DATABASE_NAME, users, module)
+        application = Application.builder().token(module.TOKEN).request(request).updater(None).build()
+        module.register_handlers(application)
+        await _prepare_bot(module, application, users)
+        applications.append(application)
+
+    gc.collect()
+    rss_after = main._process_rss()
+    return {
+        'tenants': tenants,
+        'rss_before_bytes': rss_before,
+        'rss_after_bytes': rss_after,
+        'per_tenant_kb': round((rss_after - rss_before) / tenants / 1024, 1),
+    }
+
+
+def run_worker(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    main.logger.setLevel(logging.WARNING)
+    warnings.filterwarnings('ignore', category=PTBUserWarning)
+    with tempfile.TemporaryDirectory() as workdir:
+        if args.worker == 'single':
+            result = asyncio.run(measure_single(workdir, args.users))
+        else:
+            result = asyncio.run(measure_multi(workdir, int(args.worker), args.users))
+    print(json.dumps(result))
+
+
+def _spawn(worker, users):
+    output = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--worker', worker, '--users', str(users)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def run(args):
+    single = _spawn('single', args.users)
+    result = {'users_per_tenant': args.users, 'process_per_bot_mb': round(single['rss_bytes'] / 1024 / 1024, 1), 'multi': []}
+    for tenants in args.tenants:
+        entry = _spawn(str(tenants), args.users)
+        # الذاكرة التي يحتاجها العدد نفسه من البوتات لو شُغل كل منها في عملية مستقلة
+        entry['process_per_bot_total_mb'] = round(single['rss_bytes'] * tenants / 1024 / 1024, 1)
+        entry['multi_total_mb'] = round(entry['rss_after_bytes'] / 1024 / 1024, 1)
+        result['multi'].append(entry)
+        print(json.dumps(entry), file=sys.stderr, flush=True)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Per-tenant memory overhead benchmark for multi_tenant.py.")
+    parser.add_argument('--tenants', type=lambda value: [int(n) for n in value.split(',')], default=[1, 10, 100])
+    parser.add_argument('--users', type=int, default=50, help="synthetic users per tenant")
+    parser.add_argument('--output', help="write the JSON result to this file")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.worker:
+        run_worker(args)
+        sys.exit(0)
+    result = run(args)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
@@ -0,0 +1,144 @@
+"""قياس أثر أرشفة المستخدمين غير النشطين على المسار الساخن.
+
+يبني قاعدة بيانات بعدد كبير من المستخدمين (10 ملايين افتراضياً) بتواريخ نشاط موزعة على سنة،
+ثم يؤرشف تدريجياً حسب نسب النشاط المطلوبة ويقيس عند كل نسبة: زمن get_user للمستخدمين
+النشطين، زمن get_bot_stats، وزمن الأرشفة. النسبة 1.0 هي خط الأساس دون أرشفة:
+
+    python bench_tiering.py --total 10000000 --ratios 1.0,0.5,0.2,0.05 --output tiering.json
+"""
+import os
+import json
+import time
+import random
+import logging
+import sqlite3
+import argparse
+import tempfile
+
+os.environ.setdefault("BOT_TOKEN", "999999:bench-token")
+
+import main
+
+YEAR_SECONDS = 365 * 86400
+INSERT_CHUNK = 100_000
+
+
+def build_database(path, total, seed):
+    main.DATABASE_NAME = path
+    main.init_db()
+    rng = random.Random(seed)
+    now = int(time.time())
+    started = time.perf_counter()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    for chunk_start in range(1, total + 1, INSERT_CHUNK):
+        chunk_end = min(chunk_start + INSERT_CHUNK, total + 1)
+        with conn:
+            # last_seen موزع بانتظام على السنة الماضية: نسبة النشاط r تقابل آخر r من السنة
+            conn.executemany(
+                "INSERT INTO users (user_id, balance, referral_count, referrer_id, last_seen) VALUES (?, ?, ?, 0, ?)",
+                ((user_id, rng.random() * 10, rng.randrange(3), now - int(rng.random() * YEAR_SECONDS))
+                 for user_id in range(chunk_start, chunk_end))
+            )
+    conn.close()
+    return time.perf_counter() - started
+
+
+def sample_active_ids(count):
+    conn = sqlite3.connect(main.DATABASE_NAME)
+    max_id = conn.execute("SELECT MAX(user_id) FROM users").fetchone()[0] or 0
+    rng = random.Random(1)
+    ids = set()
+    # أخذ عينات بمفتاح أساسي عشوائي بدل ORDER BY random() الذي يمسح الجدول كاملاً
+    while len(ids) < count and max_id:
+        row = conn.execute("SELECT user_id FROM users WHERE user_id >= ? LIMIT 1", (rng.randint(1, max_id),)).fetchone()
+        if row:
+            ids.add(row[0])
+    conn.close()
+    return list(ids)
+
+
+def percentile(sorted_values, pct):
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def measure_lookups(user_ids):
+    # تعطيل ذاكرة المستخدمين كي يُقاس الوصول الفعلي إلى الجدول النشط
+    main.USER_CACHE_SIZE = 0
+    main._user_cache.clear()
+    timings = []
+    for user_id in user_ids:
+        t0 = time.perf_counter()
+        main.get_user(user_id)
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+    return {
+        'lookups': len(timings),
+        'mean_us': round(sum(timings) / len(timings) * 1e6, 1) if timings else 0.0,
+        'p50_us': round(percentile(timings, 50) * 1e6, 1) if timings else 0.0,
+        'p99_us': round(percentile(timings, 99) * 1e6, 1) if timings else 0.0,
+    }
+
+
+def measure_stats(repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        stats = main.get_bot_stats()
+        timings.append(time.perf_counter() - t0)
+    return {'stats_ms': round(min(timings) * 1000, 2), 'active_users': stats['active_users'], 'archived_users': stats['archived_users']}
+
+
+def run(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    main.logger.setLevel(logging.WARNING)
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_tiering_')
+    path = os.path.join(workdir, 'tiering.db')
+    if os.path.exists(path):
+        os.remove(path)
+
+    result = {'total_users': args.total, 'build_s': round(build_database(path, args.total, args.seed), 2), 'ratios': []}
+
+    # من الأعلى إلى الأدنى كي تكون كل أرشفة امتداداً للسابقة
+    for ratio in sorted(args.ratios, reverse=True):
+        archive_started = time.perf_counter()
+        archived = main.archive_inactive_users(inactive_days=ratio * 365, batch_size=50_000, pause=0) if ratio < 1 else 0
+        archive_s = time.perf_counter() - archive_started
+
+        entry = {'active_ratio': ratio, 'archived_now': archived, 'archive_s': round(archive_s, 2)}
+        entry.update(measure_stats(args.stats_repeat))
+        entry.update(measure_lookups(sample_active_ids(args.lookups)))
+        entry['db_size_mb'] = round(main.get_db_size() / 1024 / 1024, 1)
+        result['ratios'].append(entry)
+        print(json.dumps(entry), flush=True)
+
+    if not args.workdir:
+        for name in os.listdir(workdir):
+            os.remove(os.path.join(workdir, name))
+        os.rmdir(workdir)
+    return result
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Hot/cold user tiering benchmark.")
+    parser.add_argument('--total', type=int, default=10_000_000, help="total users to generate")
+    parser.add_argument('--ratios', type=lambda value: [float(r) for r in value.split(',')], default=[1.0, 0.5, 0.2, 0.05])
+    parser.add_argument('--lookups', type=int, default=20_000)
+    parser.add_argument('--stats-repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workdir', help="keep the generated database in this directory")
+    parser.add_argument('--output', help="write the JSON result to this file")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = run(args)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
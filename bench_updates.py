@@ -0,0 +1,373 @@
+"""قياس أداء المعالجات دون اتصال عبر إعادة تشغيل تحديثات Telegram.
+
+يمرر تحديثات مسجلة (ملف JSONL) أو اصطناعية عبر Application حقيقي يحمل معالجات
+main.py، مع ناقل Bot وهمي داخل العملية، ويطبع نتائج JSON قابلة للمقارنة بين التشغيلات:
+
+    python bench_updates.py --users 200 --rounds 5 --output bench_result.json
+    python bench_updates.py --updates recorded.jsonl --compare bench_result.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import warnings
+import asyncio
+import sqlite3
+import logging
+import argparse
+import platform
+import tempfile
+from collections import Counter, defaultdict
+
+BENCH_ADMIN_ID = 1_000_000
+BENCH_BOT_ID = 999_999
+
+# يجب تعيين المتغيرات قبل استيراد main لأنه يقرأها عند الاستيراد
+os.environ.setdefault("BOT_TOKEN", f"{BENCH_BOT_ID}:bench-token")
+os.environ.setdefault("ADMIN_ID", str(BENCH_ADMIN_ID))
+
+import telegram
+from telegram import Update
+from telegram.ext import Application
+from telegram.request import BaseRequest
+
+import main
+
+# ==============================================================================
+# 1. ناقل Bot API الوهمي وعداد استعلامات قاعدة البيانات
+# ==============================================================================
+
+class FakeBotRequest(BaseRequest):
+    """ناقل HTTP وهمي يجيب على طلبات Bot API من الذاكرة ويحصي الاستدعاءات."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._next_message_id = 1
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _message(self, chat_id, message_id=None, text=None):
+        if message_id is None:
+            message_id = self._next_message_id
+            self._next_message_id += 1
+        return {
+            'message_id': int(message_id),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private'},
+            'from': {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'Bench'},
+            'text': text or '',
+        }
+
+    def _respond(self, endpoint, params):
+        if endpoint == 'getMe':
+            return {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_store_bot'}
+        if endpoint in ('sendMessage', 'sendDocument'):
+            return self._message(params['chat_id'], text=params.get('text'))
+        if endpoint == 'editMessageText':
+            return self._message(params['chat_id'], params['message_id'], params.get('text'))
+        if endpoint == 'getChatMember':
+            return {'status': 'member', 'user': {'id': int(params['user_id']), 'is_bot': False, 'first_name': 'u'}}
+        if endpoint == 'getFile':
+            return {'file_id': params['file_id'], 'file_unique_id': params['file_id'], 'file_path': 'documents/bench'}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        payload = {'ok': True, 'result': self._respond(endpoint, params)}
+        return 200, json.dumps(payload).encode('utf-8')
+
+
+class CountingSqlite:
+    """بديل لوحدة sqlite3 داخل main يحصي كل استعلام ينفذ عبر اتصالاته."""
+
+    _TRANSACTION_CONTROL = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE')
+
+    def __init__(self):
+        self.queries = 0
+
+    def __getattr__(self, name):
+        return getattr(sqlite3, name)
+
+    def _trace(self, statement):
+        if not statement.lstrip().upper().startswith(self._TRANSACTION_CONTROL):
+            self.queries += 1
+
+    def connect(self, *args, **kwargs):
+        conn = sqlite3.connect(*args, **kwargs)
+        conn.set_trace_callback(self._trace)
+        return conn
+
+# ==============================================================================
+# 2. توليد التحديثات الاصطناعية
+# ==============================================================================
+
+# أسماء بسطر واحد لأن نمط buy_file_handler لا يطابق بيانات أزرار متعددة الأسطر
+BENCH_FILES = [(f"ملف{i}", 1.0 + i % 5, f"https://example.com/f{i}.php") for i in range(20)]
+STARTING_BALANCE = 1000.0
+
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = 0
+        self.message_id = 0
+
+    def _next_ids(self):
+        self.update_id += 1
+        self.message_id += 1
+        return self.update_id, self.message_id
+
+    def message(self, user_id, text):
+        update_id, message_id = self._next_ids()
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': update_id, 'message': message}
+
+    def callback(self, user_id, data):
+        update_id, message_id = self._next_ids()
+        return {
+            'update_id': update_id,
+            'callback_query': {
+                'id': str(update_id),
+                'from': {'id': user_id, 'is_bot': False, 'first_name': f'u{user_id}'},
+                'chat_instance': str(user_id),
+                'data': data,
+                'message': {
+                    # رسالة القائمة الثابتة لكل مستخدم كي تعمل ذاكرة العرض كما في الواقع
+                    'message_id': user_id % 1_000_000 + 1,
+                    'date': int(time.time()),
+                    'chat': {'id': user_id, 'type': 'private'},
+                    'from': {'id': BENCH_BOT_ID, 'is_bot': True, 'first_name': 'Bench'},
+                    'text': 'menu',
+                },
+            },
+        }
+
+
+def synthetic_updates(users, rounds, seed=0):
+    rng = random.Random(seed)
+    factory = UpdateFactory()
+    scenarios = ['start', 'menu', 'purchase', 'transfer']
+    weights = [2, 5, 2, 1]
+    user_ids = list(range(1, users + 1))
+
+    for _ in range(rounds):
+        for user_id in user_ids:
+            kind = rng.choices(scenarios, weights)[0]
+            if kind == 'start':
+                text = f"/start {rng.choice(user_ids)}" if rng.random() < 0.3 else "/start"
+                yield kind, factory.message(user_id, text)
+            elif kind == 'menu':
+                data = rng.choice(['check_and_main_menu', 'check_and_main_menu', 'buy_file', 'earn_ruble', 'balance_info', 'user_info'])
+                yield kind, factory.callback(user_id, data)
+            elif kind == 'purchase':
+                encoded = BENCH_FILES[rng.randrange(len(BENCH_FILES))][0].replace(' ', '_')
+                yield kind, factory.callback(user_id, f'buy_file_{encoded}')
+                yield kind, factory.callback(user_id, f'confirm_buy_{encoded}')
+            elif kind == 'transfer':
+                yield kind, factory.callback(user_id, 'transfer_ruble')
+                yield kind, factory.message(user_id, '1')
+                yield kind, factory.message(user_id, str(rng.choice(user_ids)))
+
+        yield 'admin', factory.message(BENCH_ADMIN_ID, '/start')
+        for data in ('admin_stats', 'admin_list_files', 'show_admin_panel'):
+            yield 'admin', factory.callback(BENCH_ADMIN_ID, data)
+
+
+def recorded_updates(path):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            if 'update' in item:
+                yield item.get('kind', 'recorded'), item['update']
+            else:
+                kind = 'callback' if 'callback_query' in item else 'message'
+                yield kind, item
+
+# ==============================================================================
+# 3. التشغيل والقياس
+# ==============================================================================
+
+def seed_database(path, users, module=main):
+    module.DATABASE_NAME = path
+    module.init_db()
+    conn = sqlite3.connect(path)
+    with conn:
+        conn.executemany("INSERT OR IGNORE INTO files (name, price, file_link) VALUES (?, ?, ?)", BENCH_FILES)
+        conn.executemany("INSERT OR IGNORE INTO users (user_id, balance) VALUES (?, ?)",
+                         ((user_id, STARTING_BALANCE) for user_id in range(1, users + 1)))
+    conn.close()
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(pct / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, queries, api_calls):
+    ordered = sorted(latencies)
+    count = len(ordered)
+    return {
+        'updates': count,
+        'latency_ms': {
+            'mean': round(sum(ordered) / count * 1000, 3) if count else 0.0,
+            'p50': round(percentile(ordered, 50) * 1000, 3),
+            'p90': round(percentile(ordered, 90) * 1000, 3),
+            'p99': round(percentile(ordered, 99) * 1000, 3),
+            'max': round(ordered[-1] * 1000, 3) if count else 0.0,
+        },
+        'db_queries_per_update': round(queries / count, 3) if count else 0.0,
+        'bot_api_calls_per_update': round(api_calls / count, 3) if count else 0.0,
+    }
+
+
+async def replay(updates, latency=0.0):
+    request = FakeBotRequest(latency)
+    counting_sqlite = CountingSqlite()
+    errors = Counter()
+
+    async def count_error(update, context):
+        errors[type(context.error).__name__] += 1
+
+    application = Application.builder().token(main.TOKEN).request(request).updater(None).build()
+    main.register_handlers(application)
+    application.add_error_handler(count_error)
+    await application.initialize()
+
+    main.sqlite3 = counting_sqlite
+    request.calls.clear()
+
+    per_kind = defaultdict(lambda: {'latencies': [], 'queries': 0, 'api_calls': 0})
+    latencies = []
+    started = time.perf_counter()
+    try:
+        for kind, data in updates:
+            update = Update.de_json(data, application.bot)
+            queries_before = counting_sqlite.queries
+            calls_before = sum(request.calls.values())
+
+            t0 = time.perf_counter()
+            await application.process_update(update)
+            elapsed = time.perf_counter() - t0
+
+            latencies.append(elapsed)
+            bucket = per_kind[kind]
+            bucket['latencies'].append(elapsed)
+            bucket['queries'] += counting_sqlite.queries - queries_before
+            bucket['api_calls'] += sum(request.calls.values()) - calls_before
+    finally:
+        total_elapsed = time.perf_counter() - started
+        # الإشعارات تُرسل في الخلفية بعد نافذة الدمج، ننتظرها كي تُحتسب استدعاءاتها
+        while main._pending_notifications:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0)
+        main.sqlite3 = sqlite3
+        await application.shutdown()
+
+    result = summarize(latencies, counting_sqlite.queries, sum(request.calls.values()))
+    result['elapsed_s'] = round(total_elapsed, 4)
+    result['throughput_ups'] = round(len(latencies) / total_elapsed, 2) if total_elapsed else 0.0
+    result['api_calls_by_method'] = dict(sorted(request.calls.items()))
+    result['errors'] = dict(errors)
+    result['per_kind'] = {
+        kind: summarize(bucket['latencies'], bucket['queries'], bucket['api_calls'])
+        for kind, bucket in sorted(per_kind.items())
+    }
+    result['render_stats'] = dict(main.render_stats)
+    result['notification_stats'] = dict(main.notification_stats)
+    return result
+
+
+COMPARED_METRICS = [
+    ('throughput_ups',),
+    ('latency_ms', 'p50'),
+    ('latency_ms', 'p99'),
+    ('db_queries_per_update',),
+    ('bot_api_calls_per_update',),
+]
+
+def compare(baseline, current):
+    lines = []
+    for path in COMPARED_METRICS:
+        old, new = baseline, current
+        for key in path:
+            old, new = old.get(key, {}), new.get(key, {})
+        if not isinstance(old, (int, float)) or not isinstance(new, (int, float)):
+            continue
+        change = ((new - old) / old * 100) if old else 0.0
+        lines.append(f"{'.'.join(path):28} {old:>12} -> {new:>12}  ({change:+.1f}%)")
+    return '\n'.join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline update-replay benchmark for the bot handlers.")
+    parser.add_argument('--updates', help="JSONL file of recorded Update objects (one per line)")
+    parser.add_argument('--users', type=int, default=100, help="synthetic users to simulate")
+    parser.add_argument('--rounds', type=int, default=5, help="synthetic scenario rounds per user")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--api-latency-ms', type=float, default=0.0, help="simulated Bot API latency per call")
+    parser.add_argument('--output', help="write the JSON result to this file")
+    parser.add_argument('--compare', help="previous JSON result to compare against")
+    return parser.parse_args(argv)
+
+
+def run(args):
+    logging.getLogger().setLevel(logging.WARNING)
+    main.logger.setLevel(logging.WARNING)
+    warnings.filterwarnings('ignore', category=telegram.warnings.PTBUserWarning)
+    with tempfile.TemporaryDirectory() as workdir:
+        seed_database(os.path.join(workdir, 'bench.db'), args.users)
+        if args.updates:
+            updates = list(recorded_updates(args.updates))
+        else:
+            updates = list(synthetic_updates(args.users, args.rounds, args.seed))
+        result = asyncio.run(replay(updates, args.api_latency_ms / 1000))
+
+    result['config'] = {
+        'source': args.updates or 'synthetic',
+        'users': args.users,
+        'rounds': args.rounds,
+        'seed': args.seed,
+        'api_latency_ms': args.api_latency_ms,
+        'python': platform.python_version(),
+        'python_telegram_bot': telegram.__version__,
+    }
+    return result
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = run(args)
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            print(compare(json.load(f), result), file=sys.stderr)
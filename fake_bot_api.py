@@ -0,0 +1,293 @@
+"""خادم Bot API وهمي محلي لاختبارات التحمل وحدود المعدل.
+
+يحاكي getUpdates وsendMessage وeditMessageText وgetChatMember وgetMe (وبقية الطرق بردود عامة)
+مع زمن استجابة قابل للضبط، وردود 429 مع retry_after، وأخطاء 403 للمستخدمين الذين حظروا البوت.
+مع مولد الحمل المدمج يمكن تشغيل اختبار تحمل لساعات ومراقبة الذاكرة والكمون ومعالجة الأخطاء:
+
+    python fake_bot_api.py --port 8081 --load-users 500 --load-rate 50 --seed-db bot_data.db \\
+        --latency-ms 30 --global-rate 30 --blocked-ratio 0.05
+    BOT_TOKEN=1:soak ADMIN_ID=1000000 BOT_API_BASE_URL=http://127.0.0.1:8081/bot python main.py
+
+يطبع الخادم سطر JSON بالإحصائيات كل --report-interval ثانية، ويعرضها أيضاً على GET /stats.
+"""
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import itertools
+from collections import Counter, deque
+from urllib.parse import parse_qs, urlparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_BOT_ID = 999_999
+MAX_LONG_POLL = 50
+
+# ==============================================================================
+# 1. حالة الخادم
+# ==============================================================================
+
+class FakeBotAPIState:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, rate_limit_prob=0.0, retry_after=1,
+                 global_rate=0.0, blocked_ratio=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.global_rate = global_rate
+        self.blocked_ratio = blocked_ratio
+        self.rng = random.Random(seed)
+
+        self.lock = threading.Lock()
+        self.updates_ready = threading.Condition(self.lock)
+        self.updates = deque()
+        self.next_update_id = 1
+        self.enqueued_at = {}
+        self.delivery_latencies = []
+        self.next_message_id = 1
+
+        self.tokens = global_rate
+        self.tokens_refilled = time.monotonic()
+
+        self.started = time.monotonic()
+        self.calls = Counter()
+        self.counters = Counter()
+
+    # --- التحديثات ---
+
+    def push_update(self, update):
+        with self.updates_ready:
+            update = dict(update, update_id=self.next_update_id)
+            self.next_update_id += 1
+            self.updates.append(update)
+            self.enqueued_at[update['update_id']] = time.monotonic()
+            self.counters['updates_enqueued'] += 1
+            self.updates_ready.notify_all()
+
+    def get_updates(self, offset, limit, timeout):
+        deadline = time.monotonic() + min(timeout, MAX_LONG_POLL)
+        with self.updates_ready:
+            # offset يؤكد أن البوت جلب التحديثات السابقة: نقيس منه زمن التسليم (من الإدراج حتى الجلب)
+            now = time.monotonic()
+            while self.updates and self.updates[0]['update_id'] < offset:
+                acked = self.updates.popleft()
+                self.delivery_latencies.append(now - self.enqueued_at.pop(acked['update_id']))
+                self.counters['updates_acked'] += 1
+
+            while not self.updates and time.monotonic() < deadline:
+                self.updates_ready.wait(deadline - time.monotonic())
+            return list(itertools.islice(self.updates, limit))
+
+    # --- الأخطاء المحاكاة ---
+
+    def _is_blocked(self, chat_id):
+        if not self.blocked_ratio or chat_id is None:
+            return False
+        digest = hashlib.blake2b(str(chat_id).encode(), digest_size=4).digest()
+        return int.from_bytes(digest, 'big') / 2 ** 32 < self.blocked_ratio
+
+    def _take_token(self):
+        if not self.global_rate:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.global_rate, self.tokens + (now - self.tokens_refilled) * self.global_rate)
+            self.tokens_refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+    # --- الطرق ---
+
+    def _message(self, chat_id, message_id=None, text=None):
+        if message_id is None:
+            with self.lock:
+                message_id = self.next_message_id
+                self.next_message_id += 1
+        return {
+            'message_id': int(message_id),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id or 0), 'type': 'private'},
+            'from': {'id': FAKE_BOT_ID, 'is_bot': True, 'first_name': 'FakeBot'},
+            'text': text or '',
+        }
+
+    def handle(self, method, params):
+        """تعيد (رمز HTTP، جسم JSON)."""
+        with self.lock:
+            self.calls[method] += 1
+
+        if method == 'getUpdates':
+            updates = self.get_updates(int(params.get('offset', 0)), int(params.get('limit', 100)), float(params.get('timeout', 0)))
+            return 200, {'ok': True, 'result': updates}
+
+        delay = self.latency_ms + (self.rng.uniform(-self.jitter_ms, self.jitter_ms) if self.jitter_ms else 0)
+        if delay > 0:
+            time.sleep(delay / 1000)
+
+        if method == 'getMe':
+            return 200, {'ok': True, 'result': {'id': FAKE_BOT_ID, 'is_bot': True, 'first_name': 'FakeBot', 'username': 'fake_store_bot'}}
+
+        chat_id = params.get('chat_id')
+        if method in ('sendMessage', 'sendDocument', 'editMessageText'):
+            if not self._take_token() or self.rng.random() < self.rate_limit_prob:
+                self._count('rate_limited')
+                return 429, {'ok': False, 'error_code': 429,
+                             'description': f"Too Many Requests: retry after {self.retry_after}",
+                             'parameters': {'retry_after': self.retry_after}}
+            if self._is_blocked(chat_id):
+                self._count('blocked')
+                return 403, {'ok': False, 'error_code': 403, 'description': "Forbidden: bot was blocked by the user"}
+
+        if method in ('sendMessage', 'sendDocument'):
+            result = self._message(chat_id, text=params.get('text'))
+        elif method == 'editMessageText':
+            result = self._message(chat_id, params.get('message_id'), params.get('text'))
+        elif method == 'getChatMember':
+            result = {'status': 'member', 'user': {'id': int(params.get('user_id', 0)), 'is_bot': False, 'first_name': 'u'}}
+        else:
+            result = True
+        return 200, {'ok': True, 'result': result}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def snapshot(self, reset_latencies=True):
+        with self.lock:
+            latencies = sorted(self.delivery_latencies)
+            if reset_latencies:
+                self.delivery_latencies = []
+            backlog = len(self.updates)
+            calls = dict(self.calls)
+            counters = dict(self.counters)
+
+        def pct(p):
+            return round(latencies[min(len(latencies) - 1, int(p / 100 * len(latencies)))] * 1000, 1) if latencies else None
+
+        return {
+            'uptime_s': round(time.monotonic() - self.started, 1),
+            'backlog': backlog,
+            'delivery_latency_ms': {'p50': pct(50), 'p99': pct(99), 'max': pct(100), 'samples': len(latencies)},
+            'calls': calls,
+            **counters,
+        }
+
+# ==============================================================================
+# 2. خادم HTTP
+# ==============================================================================
+
+def make_handler(state):
+    class FakeBotAPIHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        # بدون هذا تؤخر خوارزمية Nagle كتابة جسم الاستجابة بعد الترويسات (~40 ms لكل طلب)
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _params(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+            content_type = self.headers.get('Content-Type', '')
+            params = {key: values[0] for key, values in parse_qs(urlparse(self.path).query).items()}
+            if content_type.startswith('application/x-www-form-urlencoded'):
+                params.update({key: values[0] for key, values in parse_qs(body.decode('utf-8')).items()})
+            elif content_type.startswith('application/json') and body:
+                params.update(json.loads(body))
+            # multipart (رفع الملفات) لا يُحلل: يكفي الرد العام للمحاكاة
+            return params
+
+        def _dispatch(self):
+            path = urlparse(self.path).path
+            if path == '/stats':
+                self._send_json(200, state.snapshot(reset_latencies=False))
+                return
+            # /bot<token>/<method>
+            parts = path.strip('/').split('/')
+            if len(parts) != 2 or not parts[0].startswith('bot'):
+                self._send_json(404, {'ok': False, 'error_code': 404, 'description': 'Not Found'})
+                return
+            status, payload = state.handle(parts[1], self._params())
+            self._send_json(status, payload)
+
+        do_GET = _dispatch
+        do_POST = _dispatch
+
+    return FakeBotAPIHandler
+
+# ==============================================================================
+# 3. مولد الحمل والتقارير
+# ==============================================================================
+
+def run_load_generator(state, users, rate, stop_event):
+    # يستورد bench_updates (ومعه main) فقط عند طلب الحمل
+    from bench_updates import synthetic_updates
+
+    interval = 1 / rate
+    next_at = time.monotonic()
+    for round_number in itertools.count():
+        for _, update in synthetic_updates(users, 1, seed=round_number):
+            if stop_event.is_set():
+                return
+            next_at += interval
+            time.sleep(max(0.0, next_at - time.monotonic()))
+            state.push_update(update)
+
+
+def run_reporter(state, interval, stop_event):
+    while not stop_event.wait(interval):
+        print(json.dumps(state.snapshot()), flush=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Local fake Telegram Bot API server for soak tests.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="added latency per Bot API call")
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--rate-limit-prob', type=float, default=0.0, help="probability of a random 429 on sends")
+    parser.add_argument('--retry-after', type=int, default=1, help="retry_after returned with 429 responses")
+    parser.add_argument('--global-rate', type=float, default=0.0, help="max sends per second before 429 (0 = unlimited)")
+    parser.add_argument('--blocked-ratio', type=float, default=0.0, help="fraction of chats that have blocked the bot")
+    parser.add_argument('--load-users', type=int, default=0, help="synthetic users for the built-in load generator")
+    parser.add_argument('--load-rate', type=float, default=20.0, help="synthetic updates per second")
+    parser.add_argument('--seed-db', help="seed this bot database with the synthetic users and files first")
+    parser.add_argument('--report-interval', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    state = FakeBotAPIState(args.latency_ms, args.jitter_ms, args.rate_limit_prob, args.retry_after,
+                            args.global_rate, args.blocked_ratio, args.seed)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    stop_event = threading.Event()
+
+    if args.seed_db:
+        from bench_updates import seed_database
+        seed_database(args.seed_db, max(args.load_users, 1))
+    if args.load_users:
+        threading.Thread(target=run_load_generator, args=(state, args.load_users, args.load_rate, stop_event), daemon=True).start()
+    threading.Thread(target=run_reporter, args=(state, args.report_interval, stop_event), daemon=True).start()
+
+    print(f"Fake Bot API listening on http://{args.host}:{args.port}/bot", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_event.set()
+        server.server_close()
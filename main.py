@@ -1,8 +1,23 @@
 import os
+import sys
+import csv
+import html
 import json
+import time
+import queue
+import atexit
+import random
+import signal
+import functools
+import contextvars
+import asyncio
+import tempfile
+import hashlib
 import sqlite3
 import telegram
 import logging
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict, deque
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -11,6 +26,7 @@ from telegram.ext import (
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    TypeHandler,
     filters
 )
 
@@ -18,11 +34,128 @@ from telegram.ext import (
 # 1. إعدادات البوت والبيئة
 # ==============================================================================
 
-# يرجى التأكد من تعيين هذه المتغيرات في بيئة التشغيل (Render/Heroku)
-TOKEN = os.environ.get("BOT_TOKEN")
-ADMIN_ID = int(os.environ.get("ADMIN_ID", "0")) 
-REQUIRED_CHANNELS = [c.strip() for c in os.environ.get("REQUIRED_CHANNELS", "").split(',') if c.strip()]
-SUPPORT_USERNAME = os.environ.get("SUPPORT_USERNAME", "support_user")
+# يرجى التأكد من تعيين هذه المتغيرات في بيئة التشغيل (Render/Heroku).
+# عند استضافة عدة بوتات في عملية واحدة (multi_tenant.py) تُنفذ هذه الوحدة مرة لكل بوت
+# بعد حقن إعداداته في TENANT_CONFIG، فتحل محل متغيرات البيئة
+_config = globals().get('TENANT_CONFIG', os.environ)
+
+# السجلات: تُوضع في طابور ويكتبها خيط خلفي، فلا ينتظر أي معالج كتابة stderr.
+# LOG_FORMAT=json (سجلات منظمة) أو text. سجلات البوت عالية التكرار (أزمنة المعالجات عند LOG_LEVEL=DEBUG)
+# تُعلَّم بـ extra={'sampled': True} ويُمرر منها LOG_DEBUG_SAMPLE_RATE فقط
+# إعداد السجلات واحد للعملية كلها (configure_logging)، لذا تُقرأ هذه من متغيرات البيئة لا من إعدادات المستأجر
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.environ.get("LOG_QUEUE_SIZE", "10000"))
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", "0.01"))
+SLOW_HANDLER_MS = float(_config.get("SLOW_HANDLER_MS", "500"))
+TEXT_LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+# حقول السياق المضافة إلى كل سجل يصدر أثناء معالجة تحديث
+LOG_CONTEXT_FIELDS = ('update_id', 'user_id', 'handler', 'duration_ms')
+_log_context = contextvars.ContextVar('log_context', default={})
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in LOG_CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    """صيغة نصية مع حقول السياق (التحديث والمستخدم والمعالج والمدة) كلاحقة key=value."""
+
+    def formatMessage(self, record):
+        # formatMessage لا format: تبقى اللاحقة في سطر الرسالة قبل أي traceback
+        text = super().formatMessage(record)
+        context = ' '.join(
+            f"{field}={getattr(record, field)}" for field in LOG_CONTEXT_FIELDS if getattr(record, field, None) is not None
+        )
+        return f"{text} [{context}]" if context else text
+
+class _LogContextFilter(logging.Filter):
+    """ينسخ سياق التحديث الحالي إلى السجل في خيط المعالج قبل وضعه في الطابور."""
+
+    def __init__(self, log_context):
+        super().__init__()
+        self.log_context = log_context
+
+    def filter(self, record):
+        for field, value in self.log_context.get().items():
+            if getattr(record, field, None) is None:
+                setattr(record, field, value)
+        return True
+
+class _SampledRecordFilter(logging.Filter):
+    """يمرر عينة من السجلات المعلّمة بـ sampled فقط؛ بقية السجلات (ومنها سجلات المكتبات) تمر كما هي."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return not getattr(record, 'sampled', False) or random.random() < self.rate
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """يضع السجلات في طابور محدود دون انتظار؛ عند امتلائه تُسقط السجلات وتُعد بدل أن يتوقف المعالج."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # الطابور داخل العملية نفسها: يكفي دمج المعاملات في الرسالة، ويبقى الاستثناء لتنسيقه في خيط الكتابة
+        record.msg, record.args = record.getMessage(), None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+def configure_logging():
+    """تمرير كل السجلات عبر طابور إلى خيط كتابة خلفي (مرة واحدة لكل عملية، حتى مع عدة مستأجرين)."""
+    global _log_context
+    root = logging.getLogger()
+    for handler in root.handlers:
+        if handler.name == 'bot-log-queue':
+            # مستأجر آخر في العملية نفسها: يكتب سياقه في متغير السياق المشترك الذي يقرؤه المرشح
+            _log_context = handler.log_context
+            return
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    writer = logging.StreamHandler()
+    writer.setFormatter(JsonLogFormatter() if LOG_FORMAT == 'json' else TextLogFormatter(TEXT_LOG_FORMAT))
+    queue_handler = _NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    queue_handler.set_name('bot-log-queue')
+    queue_handler.addFilter(_SampledRecordFilter(LOG_DEBUG_SAMPLE_RATE))
+    queue_handler.log_context = _log_context
+    queue_handler.addFilter(_LogContextFilter(_log_context))
+    root.addHandler(queue_handler)
+    root.setLevel(LOG_LEVEL)
+
+    listener = QueueListener(queue_handler.queue, writer, respect_handler_level=True)
+    listener.start()
+    # تفريغ ما تبقى في الطابور عند الخروج
+    atexit.register(listener.stop)
+
+configure_logging()
+
+TOKEN = _config.get("BOT_TOKEN")
+ADMIN_ID = int(_config.get("ADMIN_ID", "0")) 
+REQUIRED_CHANNELS = [c.strip() for c in _config.get("REQUIRED_CHANNELS", "").split(',') if c.strip()]
+SUPPORT_USERNAME = _config.get("SUPPORT_USERNAME", "support_user")
+# عنوان بديل لـ Bot API (مثل خادم fake_bot_api.py المحلي لاختبارات التحمل)
+BOT_API_BASE_URL = _config.get("BOT_API_BASE_URL")
 
 if not TOKEN:
     raise ValueError("❌ يجب تعيين BOT_TOKEN كمتغير بيئي.")
@@ -31,9 +164,8 @@ if ADMIN_ID == 0:
 
 
 REFERRAL_BONUS = 0.5  
-DATABASE_NAME = 'bot_data.db'
+DATABASE_NAME = _config.get("DATABASE_NAME", 'bot_data.db')
 
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # حالات المحادثة
@@ -41,16 +173,74 @@ AWAITING_FILE_NAME, AWAITING_FILE_PRICE, AWAITING_FILE_LINK = range(3)
 AWAITING_TRANSFER_AMOUNT, AWAITING_TRANSFER_TARGET = range(3, 5)
 AWAITING_USER_ID, AWAITING_NEW_BALANCE, AWAITING_BALANCE_CHANGE = range(5, 8) 
 AWAITING_BROADCAST_MESSAGE = 8
+AWAITING_BROADCAST_SEGMENT, AWAITING_BROADCAST_MIN_BALANCE = range(9, 11)
+
+# ذاكرة آخر عرض لكل رسالة: (chat_id, message_id) -> بصمة النص والأزرار
+RENDER_CACHE_SIZE = int(_config.get("RENDER_CACHE_SIZE", "10000"))
+_rendered_views = OrderedDict()
+render_stats = {'edits_sent': 0, 'edits_skipped': 0, 'edits_not_modified': 0}
+
+# ذاكرات القراءة: الكتالوج وبيانات المستخدمين (تُبطل عند كل كتابة)
+USER_CACHE_SIZE = int(_config.get("USER_CACHE_SIZE", "5000"))
+_user_cache = OrderedDict()
+_catalog_cache = None
+
+# مهلة تصريف التحديثات الجارية عند الإيقاف (بالثواني)
+DRAIN_TIMEOUT = float(_config.get("DRAIN_TIMEOUT", "20"))
+# دوال تفريغ الكتابات المؤجلة، تُستدعى قبل إغلاق البوت
+PENDING_WRITE_FLUSHERS = []
+
+# النسخ الاحتياطي والصيانة الدورية لقاعدة البيانات
+BACKUP_DIR = _config.get("BACKUP_DIR", "backups")
+BACKUP_KEEP = int(_config.get("BACKUP_KEEP", "3"))
+BACKUP_INTERVAL = float(_config.get("BACKUP_INTERVAL_HOURS", "6")) * 3600
+MAINTENANCE_INTERVAL = float(_config.get("MAINTENANCE_INTERVAL_HOURS", "24")) * 3600
+# أقصى مدة لإعادة المحاولة عندما تكون القاعدة مشغولة أو مقفلة قبل اعتبار النسخة فاشلة (بالثواني)؛
+# لا تقطع نسخاً جارياً لأن النسخ يتم في خطوة واحدة
+BACKUP_TIMEOUT = float(_config.get("BACKUP_TIMEOUT", "600"))
+BACKUP_STEP_SLEEP = 0.05
+VACUUM_PAGES_PER_STEP = 200
+
+# نقل المستخدمين غير النشطين إلى جدول الأرشيف (0 لتعطيل الأرشفة)
+ARCHIVE_AFTER_DAYS = int(_config.get("ARCHIVE_AFTER_DAYS", "90"))
+ARCHIVE_BATCH_SIZE = 5000
+# يُجمع النشاط في الذاكرة ويُكتب إلى last_seen على دفعات كل LAST_SEEN_FLUSH_INTERVAL ثانية،
+# ولا يُسجل للمستخدم نفسه أكثر من مرة خلال LAST_SEEN_RESOLUTION ثانية
+LAST_SEEN_RESOLUTION = 300
+LAST_SEEN_FLUSH_INTERVAL = float(_config.get("LAST_SEEN_FLUSH_INTERVAL", "60"))
+_last_touch = OrderedDict()
+_pending_last_seen = {}
+
+# طابور الإشعارات: تُجمع أحداث المستلم الواحد خلال النافذة في رسالة واحدة
+NOTIFY_COALESCE_WINDOW = float(_config.get("NOTIFY_COALESCE_WINDOW", "3"))
+NOTIFY_MAX_ATTEMPTS = 4
+_pending_notifications = {}
+# مهام التسليم الجارية: تُنتظر عند الإيقاف لأن create_task الخاص بالتطبيق لا يتتبع المهام
+# التي تُنشأ أثناء تصريف التحديثات (application.running يكون False حينها)
+_notification_tasks = set()
+# يُضبط عند الإيقاف كي تُرسل الإشعارات المعلقة فوراً دون انتظار نافذة الدمج
+_notifications_flush = asyncio.Event()
+notification_stats = {'events': 0, 'sent': 0, 'coalesced': 0, 'retried': 0, 'failed': 0}
+
+# حالة المستخدمين في الذاكرة (user_data وحالات المحادثات): تُحذف بعد فترة الخمول كي تتبع
+# الذاكرة عدد المستخدمين النشطين لا عدد كل من تفاعل مع البوت
+USER_STATE_IDLE_TIMEOUT = float(_config.get("USER_STATE_IDLE_MINUTES", "30")) * 60
+CONVERSATION_TIMEOUT = float(_config.get("CONVERSATION_TIMEOUT_MINUTES", "10")) * 60
+STATE_SWEEP_INTERVAL = 60
+_state_activity = OrderedDict()
+# آخر تحديث عالجته كل محادثة: (اسم المحادثة, (chat_id, user_id)) -> وقت monotonic
+_conversation_activity = {}
+CONVERSATION_HANDLERS = {}
 
 # ==============================================================================
 # 2. دوال قاعدة البيانات (Database Functions)
 # ==============================================================================
 
-def init_db():
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+# كل عنصر هو إصدار من المخطط؛ PRAGMA user_version يحفظ عدد الإصدارات المطبقة
+SCHEMA_MIGRATIONS = [
+    # 1: الجداول الأساسية
+    (
+        '''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             balance REAL DEFAULT 0,
@@ -58,9 +248,8 @@ def init_db():
             referrer_id INTEGER DEFAULT 0,
             is_subscribed INTEGER DEFAULT 0
         )
-    ''')
-
-    cursor.execute('''
+        ''',
+        '''
         CREATE TABLE IF NOT EXISTS files (
             id INTEGER PRIMARY KEY,
             name TEXT NOT NULL UNIQUE,
@@ -68,25 +257,256 @@ def init_db():
             file_link TEXT NOT NULL,
             is_available INTEGER DEFAULT 1
         )
-    ''')
+        ''',
+    ),
+    # 2: جداول التجميع الزمني للتحليلات (تُحدث تزايدياً مع كل حدث)
+    (
+        '''
+        CREATE TABLE IF NOT EXISTS stats_hourly (
+            bucket INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, metric)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            bucket INTEGER NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, metric)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS file_sales_daily (
+            bucket INTEGER NOT NULL,
+            file_name TEXT NOT NULL,
+            sales INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (bucket, file_name)
+        ) WITHOUT ROWID
+        ''',
+    ),
+    # 3: آخر نشاط للمستخدم وجدول أرشيف المستخدمين غير النشطين مع ملخص مجاميعه
+    (
+        "ALTER TABLE users ADD COLUMN last_seen INTEGER NOT NULL DEFAULT 0",
+        "UPDATE users SET last_seen = CAST(strftime('%s', 'now') AS INTEGER)",
+        "CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)",
+        '''
+        CREATE TABLE IF NOT EXISTS users_archive (
+            user_id INTEGER PRIMARY KEY,
+            balance REAL NOT NULL,
+            referral_count INTEGER NOT NULL,
+            referrer_id INTEGER NOT NULL,
+            last_seen INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS users_archive_summary (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            users INTEGER NOT NULL,
+            balance REAL NOT NULL,
+            referrals INTEGER NOT NULL
+        )
+        ''',
+        "INSERT OR IGNORE INTO users_archive_summary (id, users, balance, referrals) VALUES (1, 0, 0, 0)",
+    ),
+    # 4: فهرس الرصيد لاستهداف شرائح الإرسال الجماعي
+    (
+        "CREATE INDEX IF NOT EXISTS idx_users_balance ON users (balance)",
+    ),
+    # 5: معرف Telegram للمستند المرفق بالملف (يُرسل بالمعرف دون إعادة رفع)
+    (
+        "ALTER TABLE files ADD COLUMN file_id TEXT",
+    ),
+    # 6: فهارس الأرشيف كي تبقى معاينة شرائح الإرسال استعلامات مفهرسة مع ملايين المؤرشفين
+    (
+        "CREATE INDEX IF NOT EXISTS idx_users_archive_balance ON users_archive (balance)",
+        "CREATE INDEX IF NOT EXISTS idx_users_archive_last_seen ON users_archive (last_seen)",
+    ),
+]
+
+def _configure_storage(conn):
+    # وضع WAL يسمح بالقراءة (ومنها النسخ الاحتياطي) دون حجب الكتابة
+    conn.execute("PRAGMA journal_mode=WAL")
+    # auto_vacuum التزايدي يتطلب VACUUM كاملاً مرة واحدة فقط، قبل استقبال التحديثات
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+        logger.info("Database converted to incremental auto_vacuum")
+
+def init_db():
+    """تطبيق ترحيلات المخطط فقط إذا تغير PRAGMA user_version. تعيد عدد الترحيلات المطبقة."""
+    conn = sqlite3.connect(DATABASE_NAME, isolation_level=None)
+    try:
+        _configure_storage(conn)
+        current_version = conn.execute("PRAGMA user_version").fetchone()[0]
+        target_version = len(SCHEMA_MIGRATIONS)
+        if current_version >= target_version:
+            return 0
+
+        conn.execute("BEGIN")
+        try:
+            for statements in SCHEMA_MIGRATIONS[current_version:]:
+                for statement in statements:
+                    conn.execute(statement)
+            conn.execute(f"PRAGMA user_version = {target_version}")
+            conn.execute("COMMIT")
+        except sqlite3.Error:
+            conn.execute("ROLLBACK")
+            raise
+
+        logger.info(f"Schema migrated from version {current_version} to {target_version}")
+        return target_version - current_version
+    finally:
+        conn.close()
+
+def _cache_user(user):
+    _user_cache[user['user_id']] = user
+    _user_cache.move_to_end(user['user_id'])
+    while len(_user_cache) > USER_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+
+def invalidate_user(*user_ids):
+    for user_id in user_ids:
+        _user_cache.pop(user_id, None)
+
+def invalidate_catalog():
+    global _catalog_cache
+    _catalog_cache = None
+
+def warm_user_cache():
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("SELECT user_id, balance, referral_count, referrer_id FROM users ORDER BY last_seen DESC LIMIT ?", (USER_CACHE_SIZE,))
+    rows = cursor.fetchall()
+    conn.close()
+    for row in reversed(rows):
+        _cache_user({'user_id': row[0], 'balance': row[1], 'referral_count': row[2], 'referrer_id': row[3]})
+    return len(rows)
+
+def _restore_archived_user(cursor, user_id, now):
+    """إعادة مستخدم من الأرشيف إلى الجدول النشط داخل معاملة المستدعي.
+
+    آمنة عند التكرار: get_user وخيط كتابة النشاط (write_last_seen) قد يستعيدان المستخدم نفسه في الوقت نفسه.
+    """
+    cursor.execute("SELECT balance, referral_count, referrer_id FROM users_archive WHERE user_id = ?", (user_id,))
+    archived = cursor.fetchone()
+    if not archived:
+        return None
+    cursor.execute(
+        "INSERT OR IGNORE INTO users (user_id, balance, referral_count, referrer_id, last_seen) VALUES (?, ?, ?, ?, ?)",
+        (user_id, *archived, now)
+    )
+    cursor.execute("DELETE FROM users_archive WHERE user_id = ?", (user_id,))
+    if cursor.rowcount == 0:
+        # استعاده اتصال آخر بعد قراءتنا للأرشيف، والملخص حُدث هناك
+        return None
+    cursor.execute(
+        "UPDATE users_archive_summary SET users = users - 1, balance = balance - ?, referrals = referrals - ? WHERE id = 1",
+        (archived[0], archived[1])
+    )
+    return archived
+
+def touch_user(user_id, now=None):
+    """تسجيل نشاط المستخدم في الذاكرة؛ يُكتب إلى last_seen لاحقاً عبر flush_last_seen."""
+    now = int(now if now is not None else time.time())
+    last_touch = _last_touch.get(user_id)
+    if last_touch is not None and now - last_touch < LAST_SEEN_RESOLUTION:
+        return False
 
+    _pending_last_seen[user_id] = now
+    _last_touch[user_id] = now
+    _last_touch.move_to_end(user_id)
+    while len(_last_touch) > USER_CACHE_SIZE * 10:
+        _last_touch.popitem(last=False)
+    return True
+
+def take_pending_last_seen():
+    global _pending_last_seen
+    pending, _pending_last_seen = _pending_last_seen, {}
+    return pending
+
+def write_last_seen(pending):
+    """كتابة دفعة النشاط في معاملة واحدة، مع استعادة المستخدمين المؤرشفين منها."""
+    if not pending:
+        return 0
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    restored = []
+    for user_id, seen_at in pending.items():
+        cursor.execute("UPDATE users SET last_seen = MAX(last_seen, ?) WHERE user_id = ?", (seen_at, user_id))
+        if cursor.rowcount == 0 and _restore_archived_user(cursor, user_id, seen_at):
+            restored.append(user_id)
     conn.commit()
     conn.close()
+    invalidate_user(*restored)
+    return len(pending)
+
+def flush_last_seen():
+    return write_last_seen(take_pending_last_seen())
+
+PENDING_WRITE_FLUSHERS.append(flush_last_seen)
+
+def archive_inactive_users(inactive_days=None, batch_size=ARCHIVE_BATCH_SIZE, pause=BACKUP_STEP_SLEEP):
+    """نقل المستخدمين غير النشطين إلى users_archive على دفعات، كل دفعة في معاملة مستقلة."""
+    inactive_days = ARCHIVE_AFTER_DAYS if inactive_days is None else inactive_days
+    cutoff = int(time.time()) - inactive_days * 86400
+    conn = sqlite3.connect(DATABASE_NAME)
+    archived = 0
+    try:
+        while True:
+            with conn:
+                rows = conn.execute(
+                    "SELECT user_id, balance, referral_count, referrer_id, last_seen FROM users "
+                    "WHERE last_seen < ? AND user_id != ? LIMIT ?",
+                    (cutoff, ADMIN_ID, batch_size)
+                ).fetchall()
+                if not rows:
+                    break
+                conn.executemany("INSERT INTO users_archive (user_id, balance, referral_count, referrer_id, last_seen) VALUES (?, ?, ?, ?, ?)", rows)
+                conn.executemany("DELETE FROM users WHERE user_id = ?", ((row[0],) for row in rows))
+                conn.execute(
+                    "UPDATE users_archive_summary SET users = users + ?, balance = balance + ?, referrals = referrals + ? WHERE id = 1",
+                    (len(rows), sum(row[1] for row in rows), sum(row[2] for row in rows))
+                )
+            invalidate_user(*(row[0] for row in rows))
+            archived += len(rows)
+            time.sleep(pause)
+    finally:
+        conn.close()
+    return archived
+
+def _refresh_archive_summary(conn):
+    conn.execute(
+        "UPDATE users_archive_summary SET (users, balance, referrals) = "
+        "(SELECT COUNT(*), COALESCE(SUM(balance), 0), COALESCE(SUM(referral_count), 0) FROM users_archive) WHERE id = 1"
+    )
 
 def get_user(user_id):
+    cached = _user_cache.get(user_id)
+    if cached is not None:
+        _user_cache.move_to_end(user_id)
+        return dict(cached)
+
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
     cursor.execute("SELECT user_id, balance, referral_count, referrer_id FROM users WHERE user_id=?", (user_id,))
     user_data = cursor.fetchone()
     
-    if user_data:
-        conn.close()
-        return {'user_id': user_data[0], 'balance': user_data[1], 'referral_count': user_data[2], 'referrer_id': user_data[3]}
-    else:
-        cursor.execute("INSERT INTO users (user_id) VALUES (?)", (user_id,))
+    if not user_data:
+        now = int(time.time())
+        if not _restore_archived_user(cursor, user_id, now):
+            # OR IGNORE: قد يكون خيط كتابة النشاط استعاده من الأرشيف بعد قراءتنا أعلاه
+            cursor.execute("INSERT OR IGNORE INTO users (user_id, last_seen) VALUES (?, ?)", (user_id, now))
         conn.commit()
-        conn.close()
-        return {'user_id': user_id, 'balance': 0, 'referral_count': 0, 'referrer_id': 0}
+        cursor.execute("SELECT user_id, balance, referral_count, referrer_id FROM users WHERE user_id=?", (user_id,))
+        user_data = cursor.fetchone()
+    conn.close()
+    user = {'user_id': user_data[0], 'balance': user_data[1], 'referral_count': user_data[2], 'referrer_id': user_data[3]}
+
+    _cache_user(user)
+    return dict(user)
 
 def update_user_balance(user_id, amount):
     conn = sqlite3.connect(DATABASE_NAME)
@@ -94,6 +514,7 @@ def update_user_balance(user_id, amount):
     cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
     conn.commit()
     conn.close()
+    invalidate_user(user_id)
 
 def set_user_balance(user_id, new_balance):
     conn = sqlite3.connect(DATABASE_NAME)
@@ -101,11 +522,49 @@ def set_user_balance(user_id, new_balance):
     cursor.execute("UPDATE users SET balance = ? WHERE user_id = ?", (new_balance, user_id))
     conn.commit()
     conn.close()
-    
-def get_all_user_ids():
+    invalidate_user(user_id)
+    
+# --- شرائح الإرسال الجماعي (Broadcast Segments) ---
+
+BROADCAST_SEGMENTS = {
+    'all': "جميع المستخدمين",
+    'active_1': "النشطون آخر 24 ساعة",
+    'active_7': "النشطون آخر 7 أيام",
+    'active_30': "النشطون آخر 30 يوماً",
+}
+
+def _segment_query(segment, select):
+    """بناء استعلام الشريحة على الجدول النشط والأرشيف معاً، بشرط مفهرس في كليهما.
+
+    الأرشيف يُشمل حتى في شرائح النشاط لأن ARCHIVE_AFTER_DAYS قد يكون أقصر من مدة الشريحة.
+    """
+    if 'active_days' in segment:
+        condition, value = "last_seen >= ?", int(time.time()) - segment['active_days'] * 86400
+    elif 'min_balance' in segment:
+        condition, value = "balance > ?", segment['min_balance']
+    else:
+        return f"SELECT {select} FROM users UNION ALL SELECT {select} FROM users_archive", ()
+    return (f"SELECT {select} FROM users WHERE {condition} "
+            f"UNION ALL SELECT {select} FROM users_archive WHERE {condition}"), (value, value)
+
+def count_segment(segment):
+    if segment:
+        sql, params = _segment_query(segment, 'COUNT(*)')
+    else:
+        # عدد المؤرشفين من الملخص بدل مسح الأرشيف كاملاً
+        sql, params = "SELECT COUNT(*) FROM users UNION ALL SELECT users FROM users_archive_summary WHERE id = 1", ()
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute(sql, params)
+    count = sum(row[0] for row in cursor.fetchall())
+    conn.close()
+    return count
+
+def get_segment_user_ids(segment):
+    sql, params = _segment_query(segment, 'user_id')
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
-    cursor.execute("SELECT user_id FROM users")
+    cursor.execute(sql, params)
     users = [row[0] for row in cursor.fetchall()]
     conn.close()
     return users
@@ -116,30 +575,227 @@ def add_referral(user_id, referrer_id):
     cursor.execute("UPDATE users SET referrer_id = ? WHERE user_id = ?", (referrer_id, user_id))
     cursor.execute("UPDATE users SET balance = balance + ?, referral_count = referral_count + 1 WHERE user_id = ?", 
                    (REFERRAL_BONUS, referrer_id))
+    _add_rollups(cursor, {'referrals': 1, 'referral_bonus': REFERRAL_BONUS})
+    conn.commit()
+    conn.close()
+    invalidate_user(user_id, referrer_id)
+
+# --- التجميع الزمني للتحليلات (Analytics Rollups) ---
+
+HOUR_SECONDS = 3600
+DAY_SECONDS = 86400
+
+def _add_rollups(cursor, metrics, now=None):
+    """زيادة مجاميع الساعة واليوم الحاليين داخل معاملة الحدث نفسه."""
+    now = int(now if now is not None else time.time())
+    hour_bucket = now - now % HOUR_SECONDS
+    day_bucket = now - now % DAY_SECONDS
+    for table, bucket in (('stats_hourly', hour_bucket), ('stats_daily', day_bucket)):
+        cursor.executemany(
+            f"INSERT INTO {table} (bucket, metric, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(bucket, metric) DO UPDATE SET value = value + excluded.value",
+            [(bucket, metric, value) for metric, value in metrics.items()]
+        )
+    return day_bucket
+
+def record_purchase(user_id, file_name, price):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (price, user_id))
+    day_bucket = _add_rollups(cursor, {'purchases': 1, 'revenue': price})
+    cursor.execute(
+        "INSERT INTO file_sales_daily (bucket, file_name, sales, revenue) VALUES (?, ?, 1, ?) "
+        "ON CONFLICT(bucket, file_name) DO UPDATE SET sales = sales + 1, revenue = revenue + excluded.revenue",
+        (day_bucket, file_name, price)
+    )
+    conn.commit()
+    conn.close()
+    invalidate_user(user_id)
+
+def transfer_balance(sender_id, receiver_id, amount):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE users SET balance = balance - ? WHERE user_id = ?", (amount, sender_id))
+    cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, receiver_id))
+    _add_rollups(cursor, {'transfers': 1, 'transfer_volume': amount})
     conn.commit()
     conn.close()
+    invalidate_user(sender_id, receiver_id)
+
+REPORT_PERIODS = {
+    # الأيام: (جدول المصدر، صيغة تجميع العرض)
+    1: ('stats_hourly', '%H:00'),
+    7: ('stats_daily', '%m-%d'),
+    30: ('stats_daily', '%m-%d'),
+    365: ('stats_daily', '%Y-%m'),
+}
+
+def get_sales_report(days, top_files=5):
+    table, label_format = REPORT_PERIODS[days]
+    # حد أدنى واحد على حدود الأيام للسلسلة وللأكثر مبيعاً (مبيعات الملفات مجمعة يومياً):
+    # التقرير يغطي آخر days يوماً كاملاً بما فيها اليوم الحالي
+    now = int(time.time())
+    since = now - now % DAY_SECONDS - (days - 1) * DAY_SECONDS
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+
+    cursor.execute(
+        f"SELECT strftime(?, bucket, 'unixepoch') AS label, metric, SUM(value) FROM {table} "
+        "WHERE bucket >= ? GROUP BY label, metric ORDER BY MIN(bucket)",
+        (label_format, since)
+    )
+    series = OrderedDict()
+    totals = {}
+    for label, metric, value in cursor.fetchall():
+        series.setdefault(label, {})[metric] = value
+        totals[metric] = totals.get(metric, 0) + value
+
+    cursor.execute(
+        "SELECT file_name, SUM(sales) AS sales, SUM(revenue) FROM file_sales_daily "
+        "WHERE bucket >= ? GROUP BY file_name ORDER BY sales DESC LIMIT ?",
+        (since, top_files)
+    )
+    best_sellers = cursor.fetchall()
+    conn.close()
+
+    return {'series': series, 'totals': totals, 'best_sellers': best_sellers}
+
+# --- النسخ الاحتياطي والصيانة (Backup & Maintenance) ---
+
+def get_db_size():
+    """حجم ملف قاعدة البيانات مع ملف WAL بالبايت."""
+    return sum(os.path.getsize(path) for path in (DATABASE_NAME, DATABASE_NAME + '-wal') if os.path.exists(path))
+
+def backup_database():
+    """نسخة احتياطية حية عبر واجهة SQLite للنسخ في خطوة واحدة من لقطة قراءة ثابتة."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    target_path = os.path.join(BACKUP_DIR, f"bot_data-{time.strftime('%Y%m%d-%H%M%S')}.db")
+    started = time.perf_counter()
+
+    def check_deadline(status, remaining, total):
+        # يُستدعى بعد كل خطوة: النسخة المكتملة لا تُرفض، والمهلة تحد فقط إعادة المحاولة عند الانشغال أو القفل
+        if status == sqlite3.SQLITE_DONE:
+            return
+        if time.perf_counter() - started > BACKUP_TIMEOUT:
+            raise sqlite3.OperationalError(f"backup still busy/locked after {BACKUP_TIMEOUT:g}s ({remaining}/{total} pages left)")
+
+    # الكتابة في ملف مؤقت ثم إعادة التسمية: نسخة فاشلة لا تمس نسخة سابقة بالاسم نفسه
+    partial_path = target_path + '.tmp'
+    source = sqlite3.connect(DATABASE_NAME)
+    target = sqlite3.connect(partial_path)
+    completed = False
+    try:
+        # النسخ على دفعات يُعاد من البداية مع كل كتابة من اتصال آخر فلا ينتهي أثناء عمل البوت؛
+        # في وضع WAL تمسك خطوة واحدة لقطة قراءة ثابتة دون أن تحجب الكتابات
+        source.backup(target, pages=-1, progress=check_deadline, sleep=BACKUP_STEP_SLEEP)
+        completed = True
+    finally:
+        target.close()
+        source.close()
+        if completed:
+            os.replace(partial_path, target_path)
+        elif os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    backups = sorted(name for name in os.listdir(BACKUP_DIR) if name.startswith('bot_data-') and name.endswith('.db'))
+    for name in backups[:-BACKUP_KEEP]:
+        os.remove(os.path.join(BACKUP_DIR, name))
+
+    return {
+        'path': target_path,
+        'duration_s': time.perf_counter() - started,
+        'backup_size': os.path.getsize(target_path),
+        'db_size': get_db_size(),
+    }
+
+def run_db_maintenance():
+    started = time.perf_counter()
+    size_before = get_db_size()
+    conn = sqlite3.connect(DATABASE_NAME, isolation_level=None)
+    try:
+        # analysis_limit يحد من كلفة ANALYZE على الجداول الكبيرة
+        conn.execute("PRAGMA analysis_limit = 1000")
+        conn.execute("ANALYZE")
+        free_pages_before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        while conn.execute("PRAGMA freelist_count").fetchone()[0]:
+            # execute يحرر صفحة واحدة فقط لكل استدعاء، أما executescript فينفذ الدفعة كاملة
+            conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES_PER_STEP});")
+            time.sleep(BACKUP_STEP_SLEEP)
+        freed_pages = free_pages_before
+        conn.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    finally:
+        conn.close()
+
+    return {
+        'duration_s': time.perf_counter() - started,
+        'freed_pages': freed_pages,
+        'size_before': size_before,
+        'db_size': get_db_size(),
+    }
+
+def checkpoint_database():
+    conn = sqlite3.connect(DATABASE_NAME)
+    try:
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    finally:
+        conn.close()
+
+PENDING_WRITE_FLUSHERS.append(checkpoint_database)
 
 def get_all_files():
+    global _catalog_cache
+    if _catalog_cache is not None:
+        return _catalog_cache
+
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
     cursor.execute("SELECT name, price, file_link FROM files WHERE is_available = 1")
     files = cursor.fetchall()
     conn.close()
+    _catalog_cache = files
     return files
 
-def add_file_to_db(name, price, file_link):
+def add_file_to_db(name, price, file_link, file_id=None):
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
     try:
-        cursor.execute("INSERT INTO files (name, price, file_link) VALUES (?, ?, ?)",
-                       (name, price, file_link))
+        cursor.execute("INSERT INTO files (name, price, file_link, file_id) VALUES (?, ?, ?, ?)",
+                       (name, price, file_link, file_id))
         conn.commit()
+        invalidate_catalog()
         return True
     except sqlite3.IntegrityError:
         return False
     finally:
         conn.close()
 
+def get_file_details(file_name):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name, price, file_link, file_id FROM files WHERE name = ? LIMIT 1", (file_name,))
+    details = cursor.fetchone()
+    conn.close()
+    return details
+
+def find_file_by_title(title):
+    """البحث عن ملف بالسطر الأول من اسمه (الاسم الكامل قد يتضمن وصفاً متعدد الأسطر)."""
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM files WHERE name = ? OR name LIKE ? ESCAPE '\\' LIMIT 1",
+                   (title, title.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '\n%'))
+    row = cursor.fetchone()
+    conn.close()
+    return row[0] if row else None
+
+def set_file_document(file_name, file_id):
+    conn = sqlite3.connect(DATABASE_NAME)
+    cursor = conn.cursor()
+    cursor.execute("UPDATE files SET file_id = ? WHERE name = ?", (file_id, file_name))
+    updated = cursor.rowcount
+    conn.commit()
+    conn.close()
+    return updated > 0
+
 def get_bot_stats():
     conn = sqlite3.connect(DATABASE_NAME)
     cursor = conn.cursor()
@@ -149,13 +805,19 @@ def get_bot_stats():
     
     cursor.execute("SELECT COUNT(id) FROM files")
     files_count = cursor.fetchone()[0]
+
+    # مجاميع الأرشيف محفوظة مسبقاً فلا حاجة لمسح جدوله
+    cursor.execute("SELECT users, balance, referrals FROM users_archive_summary WHERE id = 1")
+    archived_users, archived_balance, archived_referrals = cursor.fetchone()
     
     conn.close()
     
     return {
-        'total_users': users_count if users_count is not None else 0,
-        'total_balance': total_balance if total_balance is not None else 0.0,
-        'total_referrals': total_referrals if total_referrals is not None else 0,
+        'total_users': (users_count or 0) + archived_users,
+        'active_users': users_count or 0,
+        'archived_users': archived_users,
+        'total_balance': (total_balance or 0.0) + archived_balance,
+        'total_referrals': (total_referrals or 0) + archived_referrals,
         'files_count': files_count
     }
 
@@ -166,8 +828,141 @@ def delete_file_from_db(file_name):
     deleted_rows = cursor.rowcount
     conn.commit()
     conn.close()
+    invalidate_catalog()
     return deleted_rows > 0
 
+# --- الاستيراد والتصدير الجماعي (Bulk Import/Export) ---
+
+BULK_BATCH_SIZE = 1000
+
+BULK_EXPORT_COLUMNS = {
+    'users': ('user_id', 'balance', 'referral_count', 'referrer_id'),
+    'files': ('name', 'price', 'file_link', 'is_available', 'file_id'),
+}
+
+BULK_EXPORT_SOURCES = {
+    'users': "SELECT {columns} FROM users UNION ALL SELECT {columns} FROM users_archive",
+    'files': "SELECT {columns} FROM files",
+}
+
+def _required(record, key):
+    # null في JSONL يعامل كحقل مفقود كي لا يُحفظ النص 'None' (مثلاً كرابط تحميل)
+    value = record[key]
+    if value is None:
+        raise KeyError(key)
+    return value
+
+def _parse_file_record(record):
+    is_available = record.get('is_available')
+    return (
+        str(_required(record, 'name')),
+        float(_required(record, 'price')),
+        str(_required(record, 'file_link')),
+        int(is_available) if is_available not in (None, '') else 1,
+        record.get('file_id') or None,
+    )
+
+def _parse_user_record(record):
+    return (int(_required(record, 'user_id')), float(_required(record, 'balance')))
+
+BULK_IMPORT_SPECS = {
+    'files': (
+        _parse_file_record,
+        "INSERT INTO files (name, price, file_link, is_available, file_id) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT(name) DO UPDATE SET price = excluded.price, file_link = excluded.file_link, "
+        "is_available = excluded.is_available, file_id = COALESCE(excluded.file_id, files.file_id)",
+    ),
+    'users': (
+        _parse_user_record,
+        "INSERT INTO users (user_id, balance, last_seen) VALUES (?, ?, CAST(strftime('%s', 'now') AS INTEGER)) "
+        "ON CONFLICT(user_id) DO UPDATE SET balance = excluded.balance",
+    ),
+}
+
+def _iter_bulk_records(path):
+    """قراءة السجلات سطراً بسطر من ملف CSV أو JSONL دون تحميله كاملاً."""
+    if path.endswith('.jsonl'):
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    else:
+        with open(path, newline='', encoding='utf-8-sig') as f:
+            yield from csv.DictReader(f)
+
+def _execute_import_batch(conn, table, sql, batch):
+    if table == 'users':
+        # المستخدمون المؤرشفون يُعادون أولاً كي لا يُنشأ لهم صف مكرر في الجدول النشط
+        user_ids = [(row[0],) for row in batch]
+        conn.executemany(
+            "INSERT OR IGNORE INTO users (user_id, balance, referral_count, referrer_id, last_seen) "
+            "SELECT user_id, balance, referral_count, referrer_id, CAST(strftime('%s', 'now') AS INTEGER) "
+            "FROM users_archive WHERE user_id = ?",
+            user_ids
+        )
+        conn.executemany("DELETE FROM users_archive WHERE user_id = ?", user_ids)
+    conn.executemany(sql, batch)
+
+def bulk_import(table, path):
+    parse_record, sql = BULK_IMPORT_SPECS[table]
+    conn = sqlite3.connect(DATABASE_NAME)
+    imported = 0
+    row_number = 0
+    try:
+        # كل الدفعات داخل معاملة واحدة: إما أن يُستورد الملف كاملاً أو لا شيء
+        with conn:
+            batch = []
+            for row_number, record in enumerate(_iter_bulk_records(path), start=1):
+                if not isinstance(record, dict):
+                    raise ValueError(f"row {row_number}: expected an object")
+                try:
+                    batch.append(parse_record(record))
+                except (KeyError, TypeError, ValueError) as e:
+                    raise ValueError(f"row {row_number}: {e!r}") from e
+                if len(batch) >= BULK_BATCH_SIZE:
+                    _execute_import_batch(conn, table, sql, batch)
+                    imported += len(batch)
+                    batch.clear()
+            if batch:
+                _execute_import_batch(conn, table, sql, batch)
+                imported += len(batch)
+            if table == 'users':
+                _refresh_archive_summary(conn)
+    except (json.JSONDecodeError, csv.Error) as e:
+        raise ValueError(f"row {row_number + 1}: {e}") from e
+    finally:
+        conn.close()
+
+    if table == 'files':
+        invalidate_catalog()
+    else:
+        _user_cache.clear()
+    return imported
+
+def bulk_export(table, path, fmt='csv'):
+    columns = BULK_EXPORT_COLUMNS[table]
+    conn = sqlite3.connect(DATABASE_NAME)
+    exported = 0
+    try:
+        cursor = conn.execute(BULK_EXPORT_SOURCES[table].format(columns=', '.join(columns)))
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f) if fmt == 'csv' else None
+            if writer:
+                writer.writerow(columns)
+            while True:
+                rows = cursor.fetchmany(BULK_BATCH_SIZE)
+                if not rows:
+                    break
+                if writer:
+                    writer.writerows(rows)
+                else:
+                    f.writelines(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows)
+                exported += len(rows)
+    finally:
+        conn.close()
+    return exported
+
 # ==============================================================================
 # 3. دوال الواجهة (UI & Check Functions)
 # ==============================================================================
@@ -221,47 +1016,219 @@ async def get_main_menu_markup(user_id):
 async def get_main_menu_text(user_id, application):
     user = get_user(user_id)
     balance = user['balance']
-    bot_info = await application.bot.get_me()
+    bot_username = application.bot.username
     
     return (
         f"مرحبا بك في بوت خدمات PHP!\n\n"
         f"اجمع نقاط واستبدلها بملفات php متطورة.\n\n"
         f"**- رصيدك = {balance:.2f} روبل**\n\n"
         f"**{user_id}** = الأيدي\n\n"
-        f"اضغط هنا لإنشاء بوت المتجر @{bot_info.username}"
+        f"اضغط هنا لإنشاء بوت المتجر @{bot_username}"
     )
     
+def _view_hash(text, reply_markup):
+    payload = json.dumps([text, reply_markup.to_dict() if reply_markup else None], sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+def remember_view(message: telegram.Message, text, reply_markup=None):
+    key = (message.chat_id, message.message_id)
+    _rendered_views[key] = _view_hash(text, reply_markup)
+    _rendered_views.move_to_end(key)
+    while len(_rendered_views) > RENDER_CACHE_SIZE:
+        _rendered_views.popitem(last=False)
+
+def forget_view(message: telegram.Message):
+    _rendered_views.pop((message.chat_id, message.message_id), None)
+
+async def edit_message_view(message: telegram.Message, text, reply_markup=None, parse_mode=None):
+    """تعديل الرسالة فقط إذا تغير النص أو الأزرار عن آخر عرض معروف لها."""
+    key = (message.chat_id, message.message_id)
+    if _rendered_views.get(key) == _view_hash(text, reply_markup):
+        render_stats['edits_skipped'] += 1
+        return
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+        render_stats['edits_sent'] += 1
+    except telegram.error.BadRequest as e:
+        # "message is not modified" يعني أن العرض مطابق أصلاً وليس فشلاً في التعديل
+        if 'message is not modified' not in str(e).lower():
+            forget_view(message)
+            raise
+        render_stats['edits_not_modified'] += 1
+    remember_view(message, text, reply_markup)
+
 async def edit_to_main_menu(message: telegram.Message, context: ContextTypes.DEFAULT_TYPE, user_id: int):
     markup = await get_main_menu_markup(user_id)
     text = await get_main_menu_text(user_id, context.application)
     
     try:
-        await message.edit_text(text, reply_markup=markup, parse_mode='HTML')
+        await edit_message_view(message, text, reply_markup=markup, parse_mode='HTML')
     except telegram.error.BadRequest:
-        await message.reply_text(text, reply_markup=markup, parse_mode='HTML')
+        sent = await message.reply_text(text, reply_markup=markup, parse_mode='HTML')
+        remember_view(sent, text, markup)
 
 
+# --- طابور الإشعارات (Notification Queue) ---
+
+def _render_notifications(events):
+    referrals = [data for kind, data in events if kind == 'referral']
+    transfers = [data for kind, data in events if kind == 'transfer']
+    parts = []
+
+    if len(referrals) == 1:
+        parts.append(f"🎁 **مبروك!** انضم مستخدم جديد عبر رابط الإحالة الخاص بك. تم إضافة **{REFERRAL_BONUS} روبل** إلى رصيدك.")
+    elif referrals:
+        parts.append(f"🎁 **مبروك!** انضم **{len(referrals)}** مستخدمين جدد عبر رابط الإحالة الخاص بك. تم إضافة **{REFERRAL_BONUS * len(referrals):.2f} روبل** إلى رصيدك.")
+
+    if len(transfers) == 1:
+        parts.append(f"🎉 **مبروك!** وصلك تحويل بقيمة **{transfers[0]['amount']:.2f} روبل** من المستخدم **{transfers[0]['sender_id']}**.")
+    elif transfers:
+        total = sum(data['amount'] for data in transfers)
+        senders = ', '.join(sorted({str(data['sender_id']) for data in transfers}))
+        parts.append(f"🎉 **مبروك!** وصلتك **{len(transfers)}** تحويلات بقيمة إجمالية **{total:.2f} روبل** من: {senders}.")
+
+    return '\n\n'.join(parts)
+
+async def _deliver_notifications(bot: telegram.Bot, chat_id: int):
+    try:
+        await asyncio.wait_for(_notifications_flush.wait(), timeout=NOTIFY_COALESCE_WINDOW)
+    except asyncio.TimeoutError:
+        pass
+    events = _pending_notifications.pop(chat_id, [])
+    if not events:
+        return
+    notification_stats['coalesced'] += len(events) - 1
+    text = _render_notifications(events)
+
+    for attempt in range(1, NOTIFY_MAX_ATTEMPTS + 1):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML')
+            notification_stats['sent'] += 1
+            return
+        except telegram.error.RetryAfter as e:
+            delay = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+        except (telegram.error.BadRequest, telegram.error.Forbidden) as e:
+            # المستخدم حظر البوت أو المحادثة غير موجودة: خطأ دائم (BadRequest فرع من NetworkError فيُلتقط قبله)
+            logger.info(f"Dropping notification to {chat_id}: {e}")
+            break
+        except (telegram.error.TimedOut, telegram.error.NetworkError):
+            delay = 2 ** (attempt - 1)
+        except telegram.error.TelegramError as e:
+            logger.info(f"Dropping notification to {chat_id}: {e}")
+            break
+        if attempt < NOTIFY_MAX_ATTEMPTS:
+            notification_stats['retried'] += 1
+            await asyncio.sleep(delay)
+
+    notification_stats['failed'] += 1
+
+def notify_user(application: Application, chat_id: int, kind: str, **data):
+    """إضافة إشعار إلى الطابور دون انتظار إرساله؛ يُرسل لاحقاً مع أحداث المستلم نفسه."""
+    notification_stats['events'] += 1
+    events = _pending_notifications.setdefault(chat_id, [])
+    events.append((kind, data))
+    if len(events) == 1:
+        task = asyncio.create_task(_deliver_notifications(application.bot, chat_id))
+        _notification_tasks.add(task)
+        task.add_done_callback(_notification_tasks.discard)
+
+async def drain_notifications(timeout):
+    """إرسال الإشعارات المعلقة فوراً وانتظار تسليمها ضمن المهلة؛ تعيد عدد ما لم يكتمل."""
+    _notifications_flush.set()
+    if not _notification_tasks:
+        return 0
+    _, pending = await asyncio.wait(set(_notification_tasks), timeout=max(0.0, timeout))
+    return len(pending)
+
 # ==============================================================================
 # 4. معالجات المستخدم (User Handlers)
 # ==============================================================================
 
 async def register_pending_referral(user_id, context: ContextTypes.DEFAULT_TYPE):
     user = get_user(user_id)
+    # يُزال المفتاح في كل الأحوال كي لا يبقى في user_data بعد تسجيل الإحالة أو رفضها
+    referrer_id = context.user_data.pop('pending_referrer', None)
     
-    if 'pending_referrer' in context.user_data and user.get('referrer_id') == 0:
-        referrer_id = context.user_data.pop('pending_referrer')
-        
+    if referrer_id is not None and user.get('referrer_id') == 0:
         referrer_user = get_user(referrer_id)
         if referrer_user['user_id'] != user_id: 
             add_referral(user_id, referrer_id)
-            await context.bot.send_message(
-                chat_id=referrer_id, 
-                text=f"🎁 **مبروك!** انضم مستخدم جديد عبر رابط الإحالة الخاص بك. تم إضافة **{REFERRAL_BONUS} روبل** إلى رصيدك.",
-                parse_mode='HTML'
-            )
+            notify_user(context.application, referrer_id, 'referral', user_id=user_id)
             return True
     return False
 
+def mark_state_activity(user_id, chat_id, now=None):
+    _state_activity[user_id] = (now if now is not None else time.monotonic(), chat_id)
+    _state_activity.move_to_end(user_id)
+
+# _track_conversation_activity و _drop_conversations و evict_idle_state تستخدم _get_key و _conversations
+# الخاصتين في ConversationHandler، لذا python-telegram-bot مقيد بإصدار أعلى في requirements.txt
+def _track_conversation_activity(name, handler):
+    """تغليف معالجات المحادثة كي يُسجل وقت آخر تحديث تعالجه هذه المحادثة لهذا المستخدم،
+    كما في conversation_timeout: نشاط المستخدم خارج المحادثة لا يمدد مهلتها."""
+    def wrap(callback):
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            _conversation_activity[(name, handler._get_key(update))] = time.monotonic()
+            return await callback(update, context)
+        return wrapper
+
+    for h in [*handler.entry_points, *(h for state in handler.states.values() for h in state), *handler.fallbacks]:
+        h.callback = wrap(h.callback)
+
+def _drop_conversations(user_id, chat_id):
+    dropped = 0
+    for name, handler in CONVERSATION_HANDLERS.items():
+        # لا توجد واجهة عامة لإنهاء محادثة دون JobQueue، لذا نحذف المفتاح (chat_id, user_id) مباشرة
+        if handler._conversations.pop((chat_id, user_id), None) is not None:
+            dropped += 1
+        _conversation_activity.pop((name, (chat_id, user_id)), None)
+    return dropped
+
+def evict_idle_state(application: Application, now=None):
+    """حذف المحادثات المتروكة وبيانات المستخدمين الخاملين من الذاكرة؛ تعيد عدد ما حُذف."""
+    now = now if now is not None else time.monotonic()
+    evicted = {'conversations': 0, 'users': 0}
+
+    # محادثة لم تعالج أي تحديث خلال المهلة تُعامل كإلغاء: تُحذف حالتها وبياناتها المؤقتة
+    for name, handler in CONVERSATION_HANDLERS.items():
+        for key in list(handler._conversations):
+            seen = _conversation_activity.get((name, key))
+            if seen is None or now - seen >= CONVERSATION_TIMEOUT:
+                del handler._conversations[key]
+                _conversation_activity.pop((name, key), None)
+                evicted['conversations'] += 1
+                application.drop_user_data(key[1])
+    # أوقات المحادثات المنتهية تُحذف بعد المهلة (لا قبلها كي لا يُحذف وقت محادثة بدأت ولم تُحفظ حالتها بعد)
+    for activity_key in [k for k, seen in _conversation_activity.items() if now - seen >= CONVERSATION_TIMEOUT]:
+        del _conversation_activity[activity_key]
+
+    # _state_activity مرتب حسب آخر نشاط، فيكفي الحذف من بدايته حتى أول مستخدم غير خامل
+    while _state_activity:
+        user_id, (seen_at, chat_id) = next(iter(_state_activity.items()))
+        if now - seen_at < USER_STATE_IDLE_TIMEOUT:
+            break
+        del _state_activity[user_id]
+        evicted['conversations'] += _drop_conversations(user_id, chat_id)
+        application.drop_user_data(user_id)
+        application.drop_chat_data(chat_id)
+        evicted['users'] += 1
+
+    # بيانات لم يُسجل لها نشاط (لا تمر عبر track_activity) تُحذف كذلك
+    for user_id in [user_id for user_id in application.user_data if user_id not in _state_activity]:
+        application.drop_user_data(user_id)
+        evicted['users'] += 1
+    active_chats = {chat_id for _, chat_id in _state_activity.values()}
+    for chat_id in [chat_id for chat_id in application.chat_data if chat_id not in active_chats]:
+        application.drop_chat_data(chat_id)
+    return evicted
+
+async def track_activity(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    if update.effective_user:
+        touch_user(update.effective_user.id)
+        chat_id = update.effective_chat.id if update.effective_chat else update.effective_user.id
+        mark_state_activity(update.effective_user.id, chat_id)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.effective_user.id
     
@@ -291,7 +1258,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     markup = await get_main_menu_markup(user_id)
     text = await get_main_menu_text(user_id, context.application)
     
-    await update.message.reply_text(text, reply_markup=markup, parse_mode='HTML')
+    sent = await update.message.reply_text(text, reply_markup=markup, parse_mode='HTML')
+    remember_view(sent, text, markup)
 
 async def show_files_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
@@ -309,7 +1277,7 @@ async def show_files_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     reply_markup = InlineKeyboardMarkup(file_keyboard)
 
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         text="العروض التي يمكنك شرائها - (اضغط على الملف للشراء أو لمعرفة التفاصيل):",
         reply_markup=reply_markup,
         parse_mode='HTML'
@@ -321,7 +1289,7 @@ async def show_earn_ruble_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     
     user_id = query.from_user.id
     
-    bot_username = (await context.application.bot.get_me()).username
+    bot_username = context.application.bot.username
     referral_link = f"https://t.me/{bot_username}?start={user_id}"
     
     user = get_user(user_id)
@@ -339,7 +1307,7 @@ async def show_earn_ruble_menu(update: Update, context: ContextTypes.DEFAULT_TYP
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    await query.edit_message_text(message_text, reply_markup=reply_markup, parse_mode='HTML')
+    await edit_message_view(query.message, message_text, reply_markup=reply_markup, parse_mode='HTML')
 
 async def prompt_buy_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_name_encoded: str) -> None:
     query = update.callback_query
@@ -356,14 +1324,14 @@ async def prompt_buy_file(update: Update, context: ContextTypes.DEFAULT_TYPE, fi
     conn.close()
     
     if not details_full:
-        await query.edit_message_text("❌ الملف غير موجود حالياً.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة", callback_data='buy_file')]]))
+        await edit_message_view(query.message, "❌ الملف غير موجود حالياً.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة", callback_data='buy_file')]]))
         return
         
     full_name, price, _ = details_full
     short_name = full_name.splitlines()[0]
     
     if user['balance'] < price:
-        await query.edit_message_text(
+        await edit_message_view(query.message,
             f"❌ **عذراً، رصيدك غير كافٍ!**\n\nرصيدك: {user['balance']:.2f} روبل\nسعر الملف: {price:.2f} روبل",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("➕ شحن الرصيد", callback_data='buy_points'), InlineKeyboardButton("↩️ العودة", callback_data='buy_file')]]),
             parse_mode='HTML'
@@ -374,12 +1342,61 @@ async def prompt_buy_file(update: Update, context: ContextTypes.DEFAULT_TYPE, fi
         [InlineKeyboardButton(f"✅ تأكيد الشراء ({price:.2f} روبل)", callback_data=f'confirm_buy_{file_name_encoded}')],
         [InlineKeyboardButton("❌ إلغاء", callback_data='buy_file')]
     ]
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         f"**هل أنت متأكد من شراء ملف '{short_name}'؟**\n\n{' '.join(full_name.splitlines()[1:])}\n\nسيتم خصم {price:.2f} روبل من رصيدك.",
         reply_markup=InlineKeyboardMarkup(keyboard),
         parse_mode='HTML'
     )
 
+INVALID_FILE_ID_ERRORS = ('file identifier', 'file_id', 'file id', 'file_reference')
+PURCHASE_DETAILS_TEMPLATE = "✅ **مبروك! تم الشراء بنجاح.**\n\n**ملف: {name}**\n\n**تفاصيل:**\n{description}"
+CAPTION_LIMIT = 1024
+
+def _is_invalid_file_id_error(error):
+    message = str(error).lower()
+    return any(marker in message for marker in INVALID_FILE_ID_ERRORS)
+
+async def deliver_purchased_file(context: ContextTypes.DEFAULT_TYPE, user_id: int, full_name: str, file_link: str, file_id):
+    short_name = full_name.splitlines()[0]
+    description = ' '.join(full_name.splitlines()[1:])
+    # اسم الملف يُهرب كي لا تفشل رسائل HTML بسبب رموز مثل < و &
+    details = PURCHASE_DETAILS_TEMPLATE.format(name=html.escape(short_name), description=html.escape(description))
+
+    if file_id:
+        # حد التعليق يُحسب على النص الظاهر، لذا يُقص النص الخام قبل التهريب كي لا ينقسم كيان مثل &amp;
+        room = CAPTION_LIMIT - len(PURCHASE_DETAILS_TEMPLATE.format(name='', description=''))
+        caption_name = short_name[:room]
+        caption = PURCHASE_DETAILS_TEMPLATE.format(
+            name=html.escape(caption_name), description=html.escape(description[:room - len(caption_name)])
+        )
+        try:
+            # الإرسال بالمعرف لا يعيد رفع الملف ولا يستهلك استضافة خارجية
+            await context.bot.send_document(chat_id=user_id, document=file_id, caption=caption, parse_mode='HTML')
+            return
+        except telegram.error.BadRequest as e:
+            # يُحذف المعرف المخزن فقط إذا رفضه Telegram لكونه غير صالح أو منتهي الصلاحية
+            if _is_invalid_file_id_error(e):
+                logger.error(f"Stored file_id for '{short_name}' was rejected, falling back to link: {e}")
+                set_file_document(full_name, None)
+            else:
+                logger.error(f"Sending document for '{short_name}' failed, falling back to link: {e}")
+
+    if not file_link:
+        # ملف مرفوع كمستند بلا رابط بديل: الشراء مسجل ويسلمه الدعم
+        logger.error(f"Purchased file '{short_name}' has no document or link to deliver to {user_id}")
+        await context.bot.send_message(
+            chat_id=user_id,
+            text=f"{details}\n\n⚠️ تعذر إرسال الملف تلقائياً. تم تسجيل عملية الشراء، يرجى التواصل مع الدعم @{SUPPORT_USERNAME} لاستلامه.",
+            parse_mode='HTML'
+        )
+        return
+
+    await context.bot.send_message(
+        chat_id=user_id,
+        text=f"{details}\n\n**رابط التحميل:**\n`{html.escape(file_link)}`\n\nيرجى حفظ الرابط.",
+        parse_mode='HTML'
+    )
+
 async def confirm_buy_file(update: Update, context: ContextTypes.DEFAULT_TYPE, file_name_encoded: str) -> None:
     query = update.callback_query
     await query.answer()
@@ -388,32 +1405,24 @@ async def confirm_buy_file(update: Update, context: ContextTypes.DEFAULT_TYPE, f
 
     file_name = file_name_encoded.replace('_', ' ')
     
-    conn = sqlite3.connect(DATABASE_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT name, price, file_link FROM files WHERE name = ? LIMIT 1", (file_name,))
-    details_full = cursor.fetchone()
-    conn.close()
+    details_full = get_file_details(file_name)
         
     if not details_full:
-        await query.edit_message_text("❌ عملية فاشلة: الملف غير موجود.", reply_markup=await get_main_menu_markup(user_id))
+        await edit_message_view(query.message, "❌ عملية فاشلة: الملف غير موجود.", reply_markup=await get_main_menu_markup(user_id))
         return
         
-    full_name, price, file_link = details_full
+    full_name, price, file_link, file_id = details_full
     short_name = full_name.splitlines()[0]
     
     if user['balance'] < price:
-        await query.edit_message_text("❌ عملية فاشلة: رصيدك أصبح غير كافٍ.", reply_markup=await get_main_menu_markup(user_id))
+        await edit_message_view(query.message, "❌ عملية فاشلة: رصيدك أصبح غير كافٍ.", reply_markup=await get_main_menu_markup(user_id))
         return
 
-    update_user_balance(user_id, -price)
+    record_purchase(user_id, full_name, price)
     
-    await context.bot.send_message(
-        chat_id=user_id,
-        text=f"✅ **مبروك! تم الشراء بنجاح.**\n\n**ملف: {short_name}**\n\n**تفاصيل:**\n{' '.join(full_name.splitlines()[1:])}\n\n**رابط التحميل:**\n`{file_link}`\n\nيرجى حفظ الرابط.",
-        parse_mode='HTML'
-    )
+    await deliver_purchased_file(context, user_id, full_name, file_link, file_id)
     
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         f"تم خصم {price:.2f} روبل من رصيدك. تحقق من رسالتك الخاصة لاستلام الملف.",
         reply_markup=await get_main_menu_markup(user_id),
         parse_mode='HTML'
@@ -425,7 +1434,7 @@ async def transfer_start(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     user = get_user(query.from_user.id)
     
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         f"**📥 تحويل روبل**\n\nرصيدك الحالي: **{user['balance']:.2f} روبل**\n\nأدخل **المبلغ** الذي تود تحويله:",
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء", callback_data='cancel_transfer')]])
@@ -468,14 +1477,10 @@ async def receive_transfer_target(update: Update, context: ContextTypes.DEFAULT_
         
         get_user(receiver_id) 
 
-        update_user_balance(sender_id, -amount)
-        update_user_balance(receiver_id, amount)
+        transfer_balance(sender_id, receiver_id, amount)
         
         await update.message.reply_text(f"✅ **تم التحويل بنجاح!** تم خصم {amount:.2f} روبل من رصيدك وتحويلها للمستخدم **{receiver_id}**.")
-        await context.bot.send_message(
-            chat_id=receiver_id,
-            text=f"🎉 **مبروك!** وصلك تحويل بقيمة **{amount:.2f} روبل** من المستخدم **{sender_id}**."
-        )
+        notify_user(context.application, receiver_id, 'transfer', amount=amount, sender_id=sender_id)
 
         context.user_data.clear()
         return ConversationHandler.END
@@ -487,7 +1492,7 @@ async def receive_transfer_target(update: Update, context: ContextTypes.DEFAULT_
 async def cancel_transfer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     query = update.callback_query
     context.user_data.clear()
-    await query.edit_message_text("✅ تم إلغاء عملية التحويل.", reply_markup=await get_main_menu_markup(query.from_user.id))
+    await edit_message_view(query.message, "✅ تم إلغاء عملية التحويل.", reply_markup=await get_main_menu_markup(query.from_user.id))
     return ConversationHandler.END
 
 # ==============================================================================
@@ -503,6 +1508,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         [InlineKeyboardButton("💰 تعديل رصيد مستخدم", callback_data='admin_edit_balance_start')],
         [InlineKeyboardButton("📊 إحصائيات البوت", callback_data='admin_stats')], # تم تفعيل الزر
         [InlineKeyboardButton("📣 إرسال رسالة جماعية", callback_data='admin_broadcast')], # تم تفعيل الزر
+        [InlineKeyboardButton("📦 استيراد/تصدير جماعي", callback_data='admin_bulk_help')],
         [InlineKeyboardButton("❌ إغلاق لوحة المشرف", callback_data='admin_close_panel')]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
@@ -511,7 +1517,7 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     
     try:
         if update.callback_query:
-            await update.callback_query.edit_message_text(
+            await edit_message_view(update.callback_query.message,
                 "👑 **لوحة تحكم المشرف المتميزة** 👑\n\nاختر الإجراء الذي تريده:",
                 reply_markup=reply_markup,
                 parse_mode='HTML'
@@ -531,7 +1537,7 @@ async def admin_prompt_add_file(update: Update, context: ContextTypes.DEFAULT_TY
     query = update.callback_query
     await query.answer()
 
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         "أدخل **اسم الملف ووصفه الكامل** (مثال:\n• ملف انشاء كروبات 💎\n• ينشأ بليوم 50 كروب\n\n**نوع الملف** php أو py)",
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
@@ -551,7 +1557,7 @@ async def admin_receive_price(update: Update, context: ContextTypes.DEFAULT_TYPE
     try:
         price = float(update.message.text)
         context.user_data['new_file_price'] = price
-        await update.message.reply_text("أدخل **رابط الملف** (مثل رابط مباشر):", parse_mode='HTML')
+        await update.message.reply_text("أدخل **رابط الملف** (مثل رابط مباشر) أو أرسل **الملف نفسه** كمستند:", parse_mode='HTML')
         return AWAITING_FILE_LINK
     except ValueError:
         await update.message.reply_text("❌ السعر غير صحيح. أدخل رقماً فقط.")
@@ -560,9 +1566,12 @@ async def admin_receive_price(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def admin_receive_link(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     file_name = context.user_data['new_file_name']
     file_price = context.user_data['new_file_price']
-    file_link = update.message.text
+    document = update.message.document
+    # عند إرسال مستند يُحفظ معرفه ليُرسل لاحقاً بالمعرف، ولا يوجد رابط خارجي
+    file_link = '' if document else update.message.text
+    file_id = document.file_id if document else None
 
-    if add_file_to_db(file_name, file_price, file_link):
+    if add_file_to_db(file_name, file_price, file_link, file_id):
         await update.message.reply_text(f"✅ تم إضافة الملف بنجاح!\nالاسم: {file_name.splitlines()[0]}\nالسعر: {file_price} روبل")
     else:
         await update.message.reply_text(f"❌ فشل الإضافة. ربما يكون الملف **{file_name.splitlines()[0]}** موجوداً بالفعل.")
@@ -578,7 +1587,7 @@ async def admin_edit_balance_start(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         "**💰 تعديل رصيد مستخدم**\n\nأرسل **آيدي (ID)** المستخدم الذي تود تعديل رصيده:",
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
@@ -615,7 +1624,7 @@ async def admin_prompt_set_balance(update: Update, context: ContextTypes.DEFAULT
     query = update.callback_query
     await query.answer()
     
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         "أرسل **قيمة الرصيد الجديدة** (مثال: `10.5`):",
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
@@ -648,7 +1657,7 @@ async def admin_prompt_change_balance(update: Update, context: ContextTypes.DEFA
     query = update.callback_query
     await query.answer()
     
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         "أرسل **قيمة التعديل** (لزيادة: `+5.0`، للنقصان: `-2.5`):",
         parse_mode='HTML',
         reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
@@ -680,6 +1689,66 @@ async def admin_change_balance(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # --- دوال الإحصائيات (Stats) ---
 
+def approx_size(obj, seen=None):
+    """حجم تقريبي بالبايت للكائن مع محتوياته المتداخلة (القواميس والقوائم والمجموعات)."""
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(approx_size(key, seen) + approx_size(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+        size += sum(approx_size(item, seen) for item in obj)
+    return size
+
+def _process_rss():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def get_memory_report(application: Application):
+    """عدد العناصر وحجمها التقريبي لكل حالة يحتفظ بها البوت في الذاكرة."""
+    sections = [
+        ('user_data', application.user_data),
+        ('chat_data', application.chat_data),
+        *((f"محادثة {name}", handler._conversations) for name, handler in CONVERSATION_HANDLERS.items()),
+        ('نشاط المستخدمين', _state_activity),
+        ('نشاط المحادثات', _conversation_activity),
+        ('ذاكرة المستخدمين', _user_cache),
+        ('ذاكرة العروض', _rendered_views),
+        ('آخر نشاط مسجل', _last_touch),
+        ('last_seen المعلق', _pending_last_seen),
+        ('الإشعارات المعلقة', _pending_notifications),
+    ]
+    rows = [(label, len(state), approx_size(dict(state))) for label, state in sections]
+    log_handler = next((h for h in logging.getLogger().handlers if h.name == 'bot-log-queue'), None)
+    return {
+        'rows': rows,
+        'non_empty_user_data': sum(1 for data in application.user_data.values() if data),
+        'rss': _process_rss(),
+        'log_queue': log_handler.queue.qsize() if log_handler else 0,
+        'log_dropped': log_handler.dropped if log_handler else 0,
+    }
+
+async def admin_show_memory(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    report = get_memory_report(context.application)
+    lines = [f"• {label}: **{count}** عنصر (~{size / 1024:.1f} KB)" for label, count, size in report['rows']]
+    rss = _format_size(report['rss']) if report['rss'] is not None else "غير متاح"
+    await update.message.reply_text(
+        "🧠 **الحالة المحفوظة في الذاكرة**\n\n" + "\n".join(lines) +
+        f"\n\n📌 user_data غير فارغة: **{report['non_empty_user_data']}**"
+        f"\n⏳ مهلة الخمول: {USER_STATE_IDLE_TIMEOUT / 60:.0f} دقيقة، مهلة المحادثة: {CONVERSATION_TIMEOUT / 60:.0f} دقيقة"
+        f"\n🖥️ ذاكرة العملية (RSS): **{rss}**"
+        f"\n🧾 طابور السجلات: {report['log_queue']} (مسقطة: {report['log_dropped']})",
+        parse_mode='HTML'
+    )
+
 async def admin_show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     await query.answer()
@@ -688,15 +1757,65 @@ async def admin_show_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     message_text = (
         "📊 **إحصائيات البوت الحالية** 📊\n\n"
-        f"👥 إجمالي المستخدمين: **{stats['total_users']}**\n"
+        f"👥 إجمالي المستخدمين: **{stats['total_users']}** (نشط: {stats['active_users']}، مؤرشف: {stats['archived_users']})\n"
         f"💰 الرصيد الكلي للمستخدمين: **{stats['total_balance']:.2f} روبل**\n"
         f"🎁 إجمالي الإحالات: **{stats['total_referrals']}**\n"
-        f"🗃️ عدد الملفات المتاحة: **{stats['files_count']}**"
+        f"🗃️ عدد الملفات المتاحة: **{stats['files_count']}**\n\n"
+        f"✂️ تعديلات رسائل تم تجنبها: **{render_stats['edits_skipped'] + render_stats['edits_not_modified']}** "
+        f"(من أصل {sum(render_stats.values())})\n"
+        f"🔔 الإشعارات: {notification_stats['sent']} مرسلة، {notification_stats['coalesced']} مدمجة، {notification_stats['failed']} فاشلة"
     )
     
-    keyboard = [[InlineKeyboardButton("↩️ العودة للوحة المشرف", callback_data='show_admin_panel')]]
+    keyboard = [
+        [InlineKeyboardButton("📈 تقارير المبيعات والإحالات", callback_data='admin_report_7')],
+        [InlineKeyboardButton("↩️ العودة للوحة المشرف", callback_data='show_admin_panel')]
+    ]
     
-    await query.edit_message_text(message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+    await edit_message_view(query.message, message_text, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
+
+async def admin_show_report(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+    if query.from_user.id != ADMIN_ID:
+        return
+
+    days = int(query.data.replace('admin_report_', ''))
+    if days not in REPORT_PERIODS:
+        days = 7
+
+    started = time.perf_counter()
+    report = get_sales_report(days)
+    elapsed_ms = (time.perf_counter() - started) * 1000
+    totals = report['totals']
+
+    lines = [
+        f"📈 **تقرير آخر {days} يوم** 📈\n",
+        f"🛒 المشتريات: **{int(totals.get('purchases', 0))}** | الإيرادات: **{totals.get('revenue', 0):.2f} روبل**",
+        f"📥 التحويلات: **{int(totals.get('transfers', 0))}** | الحجم: **{totals.get('transfer_volume', 0):.2f} روبل**",
+        f"🎁 الإحالات: **{int(totals.get('referrals', 0))}**\n",
+    ]
+
+    if report['series']:
+        lines.append("**الفترة: إيرادات | مشتريات | إحالات**")
+        for label, metrics in list(report['series'].items())[-24:]:
+            lines.append(f"{label}: {metrics.get('revenue', 0):.2f} | {int(metrics.get('purchases', 0))} | {int(metrics.get('referrals', 0))}")
+    else:
+        lines.append("لا توجد أحداث في هذه الفترة.")
+
+    if report['best_sellers']:
+        lines.append("\n🏆 **الأكثر مبيعاً:**")
+        for file_name, sales, revenue in report['best_sellers']:
+            lines.append(f"• {file_name.splitlines()[0]}: {sales} عملية ({revenue:.2f} روبل)")
+
+    lines.append(f"\n⏱️ {elapsed_ms:.1f} ms")
+
+    keyboard = [
+        [InlineKeyboardButton(label, callback_data=f'admin_report_{period}')
+         for period, label in ((1, "اليوم"), (7, "7 أيام"), (30, "30 يوم"), (365, "سنة"))],
+        [InlineKeyboardButton("↩️ العودة للإحصائيات", callback_data='admin_stats')]
+    ]
+
+    await edit_message_view(query.message, '\n'.join(lines), reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='HTML')
 
 # --- دوال الإرسال الجماعي (Broadcast) ---
 
@@ -704,16 +1823,63 @@ async def admin_prompt_broadcast(update: Update, context: ContextTypes.DEFAULT_T
     query = update.callback_query
     await query.answer()
 
-    await query.edit_message_text(
-        "📣 **الإرسال الجماعي**\n\nأرسل **الرسالة** التي تود إرسالها لجميع مستخدمي البوت (يمكنك استخدام HTML):",
+    keyboard = [[InlineKeyboardButton(label, callback_data=f'bc_seg_{key}')] for key, label in BROADCAST_SEGMENTS.items()]
+    keyboard.append([InlineKeyboardButton("💰 رصيد أكبر من قيمة محددة", callback_data='bc_seg_balance')])
+    keyboard.append([InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')])
+
+    await edit_message_view(query.message,
+        "📣 **الإرسال الجماعي**\n\nاختر **الشريحة** التي تود إرسال الرسالة إليها:",
         parse_mode='HTML',
-        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
+        reply_markup=InlineKeyboardMarkup(keyboard)
     )
+    return AWAITING_BROADCAST_SEGMENT
+
+async def _preview_broadcast_segment(message: telegram.Message, context: ContextTypes.DEFAULT_TYPE, segment, label, edit=False) -> int:
+    # كتابة النشاط المعلق أولاً كي تعكس الشريحة آخر التفاعلات
+    await asyncio.to_thread(flush_last_seen)
+    count = await asyncio.to_thread(count_segment, segment)
+    context.user_data['broadcast_segment'] = segment
+
+    text = (
+        f"📣 **الشريحة:** {label}\n"
+        f"👥 **عدد المستلمين:** {count}\n\n"
+        "أرسل **الرسالة** التي تود إرسالها (يمكنك استخدام HTML):"
+    )
+    reply_markup = InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
+    if edit:
+        await edit_message_view(message, text, reply_markup=reply_markup, parse_mode='HTML')
+    else:
+        await message.reply_text(text, reply_markup=reply_markup, parse_mode='HTML')
     return AWAITING_BROADCAST_MESSAGE
 
+async def admin_choose_broadcast_segment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    query = update.callback_query
+    await query.answer()
+    key = query.data.replace('bc_seg_', '')
+
+    if key == 'balance':
+        await edit_message_view(query.message,
+            "أرسل **الحد الأدنى للرصيد** (مثال: `5`) لاستهداف من يزيد رصيدهم عنه:",
+            parse_mode='HTML',
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("❌ إلغاء العملية", callback_data='cancel_admin')]])
+        )
+        return AWAITING_BROADCAST_MIN_BALANCE
+
+    segment = {'active_days': int(key.replace('active_', ''))} if key.startswith('active_') else {}
+    return await _preview_broadcast_segment(query.message, context, segment, BROADCAST_SEGMENTS.get(key, key), edit=True)
+
+async def admin_receive_broadcast_min_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    try:
+        min_balance = float(update.message.text)
+    except ValueError:
+        await update.message.reply_text("❌ القيمة المدخلة غير صحيحة. أدخل رقماً فقط.")
+        return AWAITING_BROADCAST_MIN_BALANCE
+
+    return await _preview_broadcast_segment(update.message, context, {'min_balance': min_balance}, f"رصيد أكبر من {min_balance:.2f} روبل")
+
 async def admin_send_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     message_text = update.message.text
-    all_user_ids = get_all_user_ids()
+    all_user_ids = await asyncio.to_thread(get_segment_user_ids, context.user_data.get('broadcast_segment', {}))
     sent_count = 0
     failed_count = 0
     
@@ -746,7 +1912,7 @@ async def admin_list_files_for_management(update: Update, context: ContextTypes.
     available_files = get_all_files()
 
     if not available_files:
-        await query.edit_message_text(
+        await edit_message_view(query.message,
             "🗃️ لا توجد ملفات حالياً لإدارتها.",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة للوحة المشرف", callback_data='show_admin_panel')]])
         )
@@ -762,7 +1928,7 @@ async def admin_list_files_for_management(update: Update, context: ContextTypes.
 
     reply_markup = InlineKeyboardMarkup(file_keyboard)
 
-    await query.edit_message_text(
+    await edit_message_view(query.message,
         text="📝 **إدارة/تعديل الملفات**\n\nاضغط على الزر لحذف الملف نهائياً:",
         reply_markup=reply_markup,
         parse_mode='HTML'
@@ -775,16 +1941,165 @@ async def admin_confirm_delete_file(update: Update, context: ContextTypes.DEFAUL
     file_name = file_name_encoded.replace('_', ' ')
     
     if delete_file_from_db(file_name):
-        await query.edit_message_text(
+        await edit_message_view(query.message,
             f"✅ **تم حذف الملف بنجاح!**\n{file_name.splitlines()[0]}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة للوحة المشرف", callback_data='show_admin_panel')]])
         )
     else:
-        await query.edit_message_text(
+        await edit_message_view(query.message,
             f"❌ فشل حذف الملف: {file_name.splitlines()[0]}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة للوحة المشرف", callback_data='show_admin_panel')]])
         )
 
+# --- دوال الاستيراد والتصدير الجماعي (Bulk Import/Export) ---
+
+async def admin_show_bulk_help(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    query = update.callback_query
+    await query.answer()
+
+    await edit_message_view(query.message,
+        "📦 **الاستيراد والتصدير الجماعي**\n\n"
+        "• للاستيراد: أرسل ملف CSV أو JSONL مع التعليق `/import_files` أو `/import_users`\n"
+        "  - الملفات: name, price, file_link, is_available (اختياري)\n"
+        "  - المستخدمون: user_id, balance\n"
+        "• للتصدير: `/export_files` أو `/export_users` (أضف `jsonl` لتغيير الصيغة)\n"
+        "• نسخة احتياطية فورية لقاعدة البيانات: `/backup`\n"
+        "• لإرفاق مستند بملف موجود: أرسل المستند مع التعليق `/attach_file <السطر الأول من اسم الملف>`",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة للوحة المشرف", callback_data='show_admin_panel')]]),
+        parse_mode='HTML'
+    )
+
+async def admin_import_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.message
+    table = 'files' if message.caption.startswith('/import_files') else 'users'
+    document = message.document
+    suffix = '.jsonl' if (document.file_name or '').lower().endswith(('.jsonl', '.json')) else '.csv'
+
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        tg_file = await document.get_file()
+        await tg_file.download_to_drive(path)
+        started = time.perf_counter()
+        imported = await asyncio.to_thread(bulk_import, table, path)
+        elapsed = time.perf_counter() - started
+    except (ValueError, csv.Error, sqlite3.Error) as e:
+        logger.warning(f"Bulk import into {table} failed: {e}")
+        await message.reply_text(f"❌ فشل الاستيراد ولم يتم حفظ أي سجل.\n{e}")
+        return
+    finally:
+        os.remove(path)
+
+    await message.reply_text(f"✅ تم استيراد **{imported}** سجل إلى `{table}` خلال {elapsed:.2f} ثانية.")
+
+async def admin_attach_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    message = update.message
+    title = message.caption.replace('/attach_file', '', 1).strip()
+    file_name = find_file_by_title(title) if title else None
+
+    if not file_name:
+        await message.reply_text("❌ لم يتم العثور على الملف. استخدم التعليق: `/attach_file <السطر الأول من اسم الملف>`", parse_mode='HTML')
+        return
+
+    set_file_document(file_name, message.document.file_id)
+    await message.reply_text(f"✅ تم إرفاق المستند بالملف **{file_name.splitlines()[0]}**. سيُرسل للمشترين مباشرة.", parse_mode='HTML')
+
+async def admin_export_table(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    command = update.message.text.split()[0].lstrip('/').split('@')[0]
+    table = command.replace('export_', '')
+    fmt = 'jsonl' if context.args and context.args[0].lower() == 'jsonl' else 'csv'
+
+    fd, path = tempfile.mkstemp(suffix=f'.{fmt}')
+    os.close(fd)
+    try:
+        exported = await asyncio.to_thread(bulk_export, table, path, fmt)
+        with open(path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=update.effective_chat.id,
+                document=f,
+                filename=f"{table}.{fmt}",
+                caption=f"📤 تم تصدير {exported} سجل من `{table}`."
+            )
+    finally:
+        os.remove(path)
+
+# --- دوال النسخ الاحتياطي والصيانة (Backup & Maintenance) ---
+
+def _format_size(size):
+    return f"{size / 1024 / 1024:.2f} MB"
+
+async def report_backup(bot: telegram.Bot, result, previous_size=None):
+    growth = f" (النمو: {_format_size(result['db_size'] - previous_size)})" if previous_size is not None else ""
+    text = (
+        "💾 **تم أخذ نسخة احتياطية من قاعدة البيانات**\n\n"
+        f"⏱️ المدة: {result['duration_s']:.2f} ثانية\n"
+        f"📦 حجم النسخة: {_format_size(result['backup_size'])}\n"
+        f"🗄️ حجم قاعدة البيانات: {_format_size(result['db_size'])}{growth}"
+    )
+    if ADMIN_ID:
+        await bot.send_message(chat_id=ADMIN_ID, text=text, parse_mode='HTML')
+
+async def admin_backup_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    await update.message.reply_text("⏳ جاري أخذ نسخة احتياطية...")
+    try:
+        result = await asyncio.to_thread(backup_database)
+    except (OSError, sqlite3.Error) as e:
+        logger.error(f"Manual backup failed: {e}")
+        await update.message.reply_text(f"❌ فشل النسخ الاحتياطي: {e}")
+        return
+    await report_backup(context.bot, result)
+
+async def last_seen_flush_loop():
+    """مهمة خلفية: كتابة النشاط المجمع في الذاكرة إلى last_seen على دفعات."""
+    while True:
+        await asyncio.sleep(LAST_SEEN_FLUSH_INTERVAL)
+        pending = take_pending_last_seen()
+        try:
+            await asyncio.to_thread(write_last_seen, pending)
+        except sqlite3.Error as e:
+            # إعادة الدفعة إلى الذاكرة دون الكتابة فوق نشاط أحدث
+            for user_id, seen_at in pending.items():
+                _pending_last_seen.setdefault(user_id, seen_at)
+            logger.error(f"Failed to flush last_seen batch of {len(pending)}: {e}")
+
+async def state_eviction_loop(application: Application):
+    """مهمة خلفية: حذف المحادثات المتروكة وحالة المستخدمين الخاملين من الذاكرة."""
+    while True:
+        await asyncio.sleep(STATE_SWEEP_INTERVAL)
+        evicted = evict_idle_state(application)
+        if evicted['users'] or evicted['conversations']:
+            logger.info(f"Evicted idle state: users={evicted['users']} conversations={evicted['conversations']}")
+
+async def db_maintenance_loop(application: Application):
+    """مهمة خلفية: نسخ احتياطي وصيانة دورية في خيط منفصل كي لا تحجب المعالجات."""
+    next_backup = time.monotonic() + BACKUP_INTERVAL
+    next_maintenance = time.monotonic() + MAINTENANCE_INTERVAL
+    last_reported_size = get_db_size()
+
+    while True:
+        await asyncio.sleep(max(0.0, min(next_backup, next_maintenance) - time.monotonic()))
+        now = time.monotonic()
+        try:
+            if now >= next_maintenance:
+                next_maintenance = now + MAINTENANCE_INTERVAL
+                if ARCHIVE_AFTER_DAYS > 0:
+                    await asyncio.to_thread(flush_last_seen)
+                    archived = await asyncio.to_thread(archive_inactive_users)
+                    logger.info(f"Archived {archived} users inactive for more than {ARCHIVE_AFTER_DAYS} days")
+                result = await asyncio.to_thread(run_db_maintenance)
+                logger.info(
+                    f"DB maintenance: duration_s={result['duration_s']:.2f} freed_pages={result['freed_pages']} "
+                    f"size_before={result['size_before']} size_after={result['db_size']}"
+                )
+            if now >= next_backup:
+                next_backup = now + BACKUP_INTERVAL
+                result = await asyncio.to_thread(backup_database)
+                logger.info(f"DB backup: duration_s={result['duration_s']:.2f} path={result['path']} db_size={result['db_size']}")
+                await report_backup(application.bot, result, last_reported_size)
+                last_reported_size = result['db_size']
+        except (OSError, sqlite3.Error, telegram.error.TelegramError) as e:
+            logger.error(f"Scheduled DB maintenance failed: {e}")
+
 # --- دوال الإلغاء والإغلاق العامة ---
 
 async def cancel_admin_action(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -805,8 +2120,9 @@ async def admin_close_panel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer("تم إغلاق اللوحة.")
     try:
         await query.message.delete()
+        forget_view(query.message)
     except Exception:
-        await query.edit_message_text("✅ تم إغلاق لوحة المشرف.", reply_markup=None)
+        await edit_message_view(query.message, "✅ تم إغلاق لوحة المشرف.", reply_markup=None)
 
 # ==============================================================================
 # 6. معالج الأزرار الموحد (Callback Query Handler)
@@ -842,7 +2158,7 @@ async def main_callback_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await query.answer(f"معلوماتك:\nالآيدي: {user_id}\nالرصيد: {user['balance']:.2f} روبل\nالإحالات: {user['referral_count']}\nالمُحيل: {referrer_info}", show_alert=True)
         
     elif data == 'buy_points':
-        await query.edit_message_text(
+        await edit_message_view(query.message,
             "**لشحن رصيدك، يرجى التواصل مع الدعم الفني:**\n"
             f"@{SUPPORT_USERNAME}",
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("↩️ العودة للقائمة الرئيسية", callback_data='check_and_main_menu')]]),
@@ -875,27 +2191,71 @@ async def admin_delete_file_handler(update: Update, context: ContextTypes.DEFAUL
 # 7. الإعداد والتشغيل (Long Polling)
 # ==============================================================================
 
-if __name__ == '__main__':
-    init_db()
-    application = Application.builder().token(TOKEN).build()
+def _timed_callback(callback):
+    """تغليف المعالج: سياق السجلات (التحديث والمستخدم واسم المعالج) وتسجيل مدة التنفيذ."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        user = update.effective_user if isinstance(update, Update) else None
+        token = _log_context.set({
+            'update_id': update.update_id if isinstance(update, Update) else None,
+            'user_id': user.id if user else None,
+            'handler': callback.__name__,
+        })
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            duration_ms = round((time.perf_counter() - started) * 1000, 2)
+            if duration_ms >= SLOW_HANDLER_MS:
+                logger.warning("Slow handler", extra={'duration_ms': duration_ms})
+            else:
+                logger.debug("Handler finished", extra={'duration_ms': duration_ms, 'sampled': True})
+            _log_context.reset(token)
+    return wrapper
+
+def _instrument_handlers(application: Application):
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            inner = [handler]
+            if isinstance(handler, ConversationHandler):
+                inner = [*handler.entry_points, *(h for state in handler.states.values() for h in state), *handler.fallbacks]
+            for h in inner:
+                h.callback = _timed_callback(h.callback)
+
+async def log_update_error(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    user = update.effective_user if isinstance(update, Update) else None
+    logger.error(
+        "Update handling failed",
+        exc_info=context.error,
+        extra={'update_id': getattr(update, 'update_id', None), 'user_id': user.id if user else None},
+    )
+
+def register_handlers(application: Application) -> None:
+    """تسجيل جميع معالجات البوت على التطبيق (يُستخدم أيضاً في أدوات القياس)."""
+
+    # تسجيل النشاط قبل بقية المعالجات (المجموعة -1 لا توقف معالجة التحديث)
+    application.add_handler(TypeHandler(Update, track_activity), group=-1)
 
     # Conversation Handlers 
 
     # 1. إضافة ملف (Add File)
     admin_add_file_conv = ConversationHandler(
+        name='add_file',
         entry_points=[CallbackQueryHandler(admin_prompt_add_file, pattern='^admin_add_file$')],
         states={
             AWAITING_FILE_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), admin_receive_name)],
             AWAITING_FILE_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), admin_receive_price)],
-            AWAITING_FILE_LINK: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), admin_receive_link)],
+            AWAITING_FILE_LINK: [MessageHandler(((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL) & filters.User(ADMIN_ID), admin_receive_link)],
         },
         fallbacks=[CommandHandler('cancel', cancel_admin_action), CallbackQueryHandler(cancel_admin_action, pattern='^cancel_admin$')],
         allow_reentry=True
     )
     application.add_handler(admin_add_file_conv)
+    CONVERSATION_HANDLERS['add_file'] = admin_add_file_conv
 
     # 2. تحويل الروبل (Transfer Ruble)
     transfer_conv = ConversationHandler(
+        name='transfer',
         entry_points=[CallbackQueryHandler(transfer_start, pattern='^transfer_ruble$')],
         states={
             AWAITING_TRANSFER_AMOUNT: [MessageHandler(filters.TEXT & ~filters.COMMAND, receive_transfer_amount)],
@@ -905,9 +2265,11 @@ if __name__ == '__main__':
         allow_reentry=True
     )
     application.add_handler(transfer_conv)
+    CONVERSATION_HANDLERS['transfer'] = transfer_conv
     
     # 3. تعديل رصيد المشرف (Admin Edit Balance)
     admin_edit_balance_conv = ConversationHandler(
+        name='edit_balance',
         entry_points=[CallbackQueryHandler(admin_edit_balance_start, pattern='^admin_edit_balance_start$')],
         states={
             AWAITING_USER_ID: [
@@ -922,22 +2284,41 @@ if __name__ == '__main__':
         allow_reentry=True
     )
     application.add_handler(admin_edit_balance_conv)
+    CONVERSATION_HANDLERS['edit_balance'] = admin_edit_balance_conv
     
     # 4. الإرسال الجماعي (Broadcast)
     admin_broadcast_conv = ConversationHandler(
+        name='broadcast',
         entry_points=[CallbackQueryHandler(admin_prompt_broadcast, pattern='^admin_broadcast$')],
         states={
+            AWAITING_BROADCAST_SEGMENT: [CallbackQueryHandler(admin_choose_broadcast_segment, pattern='^bc_seg_')],
+            AWAITING_BROADCAST_MIN_BALANCE: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), admin_receive_broadcast_min_balance)],
             AWAITING_BROADCAST_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND & filters.User(ADMIN_ID), admin_send_broadcast)],
         },
         fallbacks=[CommandHandler('cancel', cancel_admin_action), CallbackQueryHandler(cancel_admin_action, pattern='^cancel_admin$')],
         allow_reentry=True
     )
     application.add_handler(admin_broadcast_conv)
+    CONVERSATION_HANDLERS['broadcast'] = admin_broadcast_conv
+
+    for name, handler in CONVERSATION_HANDLERS.items():
+        _track_conversation_activity(name, handler)
 
 
     # Command Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin_panel, filters=filters.User(ADMIN_ID))) 
+    application.add_handler(CommandHandler(["export_users", "export_files"], admin_export_table, filters=filters.User(ADMIN_ID)))
+    application.add_handler(CommandHandler("backup", admin_backup_now, filters=filters.User(ADMIN_ID)))
+    application.add_handler(CommandHandler("memory", admin_show_memory, filters=filters.User(ADMIN_ID)))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.User(ADMIN_ID) & filters.CaptionRegex(r'^/import_(files|users)\b'),
+        admin_import_document
+    ))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.User(ADMIN_ID) & filters.CaptionRegex(r'^/attach_file\b'),
+        admin_attach_document
+    ))
     
     # Callback Query Handlers (الأزرار)
     
@@ -972,10 +2353,116 @@ if __name__ == '__main__':
             CallbackQueryHandler(admin_list_files_for_management, pattern='^admin_list_files$')
         )
 
+        # معالج تقارير المبيعات المجمعة زمنياً
+        application.add_handler(
+            CallbackQueryHandler(admin_show_report, pattern='^admin_report_\\d+$')
+        )
+
+        # معالج تعليمات الاستيراد والتصدير الجماعي
+        application.add_handler(
+            CallbackQueryHandler(admin_show_bulk_help, pattern='^admin_bulk_help$')
+        )
+
     # المعالج العام لبقية أزرار القائمة الرئيسية (يجب أن يكون الأخير)
     application.add_handler(CallbackQueryHandler(main_callback_handler))
 
+    _instrument_handlers(application)
+    application.add_error_handler(log_update_error)
+
+
+async def warm_caches(application: Application):
+    """تسخين ذاكرتي الكتالوج والمستخدمين بالتوازي قبل استقبال التحديثات.
+
+    هوية البوت (bot.username) مسخنة مسبقاً: application.initialize() يستدعي getMe ويحفظ النتيجة.
+    """
+    catalog, users_count = await asyncio.gather(
+        asyncio.to_thread(get_all_files),
+        asyncio.to_thread(warm_user_cache),
+    )
+    return len(catalog), users_count
+
+def flush_pending_writes():
+    for flush in PENDING_WRITE_FLUSHERS:
+        try:
+            flush()
+        except Exception as e:
+            logger.error(f"Failed to flush pending writes via {flush.__name__}: {e}")
+
+async def start_bot(application: Application):
+    """تهيئة البوت وتسخين ذاكراته ثم بدء الاستطلاع والمهام الخلفية؛ تعيد المهام ومقاييس التسخين."""
+    await application.initialize()
+    warmup_started = time.perf_counter()
+    files_count, users_count = await warm_caches(application)
+    warmup_ms = (time.perf_counter() - warmup_started) * 1000
+
+    await application.updater.start_polling(poll_interval=1.0)
+    await application.start()
+    tasks = [
+        asyncio.create_task(db_maintenance_loop(application)),
+        asyncio.create_task(last_seen_flush_loop()),
+        asyncio.create_task(state_eviction_loop(application)),
+    ]
+    return tasks, {'warmup_ms': warmup_ms, 'warm_files': files_count, 'warm_users': users_count}
+
+async def stop_bot(application: Application, tasks):
+    """1) إيقاف جلب التحديثات 2) تصريف التحديثات الجارية ضمن مهلة 3) تفريغ الكتابات المؤجلة."""
+    drain_started = time.perf_counter()
+    for task in tasks:
+        task.cancel()
+    await application.updater.stop()
+    pending = application.update_queue.qsize()
+    drained = True
+    try:
+        await asyncio.wait_for(asyncio.shield(application.stop()), timeout=DRAIN_TIMEOUT)
+    except asyncio.TimeoutError:
+        drained = False
+        logger.warning(f"Drain deadline of {DRAIN_TIMEOUT:.0f}s exceeded, {application.update_queue.qsize()} updates left unprocessed")
+
+    # الإشعارات الناتجة عن التحديثات المصرفة تُرسل قبل إغلاق اتصالات البوت
+    notifications_left = await drain_notifications(DRAIN_TIMEOUT - (time.perf_counter() - drain_started))
+    if notifications_left:
+        logger.warning(f"{notifications_left} notification deliveries did not finish before shutdown")
+
+    flush_pending_writes()
+    if drained:
+        await application.shutdown()
+    return {
+        'drain_ms': (time.perf_counter() - drain_started) * 1000,
+        'pending_at_stop': pending,
+        'drained': drained,
+        'notifications_left': notifications_left,
+    }
+
+async def serve(application: Application, started: float, migrations_ms: float):
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    tasks, warmup = await start_bot(application)
+    logger.info(
+        f"Startup metrics: startup_ms={(time.perf_counter() - started) * 1000:.1f} "
+        f"migrations_ms={migrations_ms:.1f} warmup_ms={warmup['warmup_ms']:.1f} "
+        f"warm_files={warmup['warm_files']} warm_users={warmup['warm_users']}"
+    )
     logger.info("🤖 البوت جاهز للتشغيل في وضع الاستطلاع الطويل (Long Polling)...")
-    
-    # تشغيل البوت في وضع الاستطلاع الطويل
-    application.run_polling(poll_interval=1.0)
+
+    await stop_event.wait()
+
+    metrics = await stop_bot(application, tasks)
+    logger.info(f"Shutdown metrics: drain_ms={metrics['drain_ms']:.1f} pending_at_stop={metrics['pending_at_stop']} drained={metrics['drained']}")
+
+
+if __name__ == '__main__':
+    started = time.perf_counter()
+    init_db()
+    migrations_ms = (time.perf_counter() - started) * 1000
+
+    builder = Application.builder().token(TOKEN)
+    if BOT_API_BASE_URL:
+        builder = builder.base_url(BOT_API_BASE_URL)
+    application = builder.build()
+    register_handlers(application)
+
+    # تشغيل البوت في وضع الاستطلاع الطويل مع تسخين مسبق وتصريف آمن عند الإيقاف
+    asyncio.run(serve(application, started, migrations_ms))
@@ -0,0 +1,202 @@
+"""استضافة عدة بوتات متاجر في عملية واحدة وحلقة أحداث واحدة.
+
+يُعرّف كل بوت (مستأجر) في سجل JSON بإعدادات تحمل أسماء متغيرات البيئة نفسها التي يقرؤها main.py:
+
+    [
+      {"id": "shop1", "BOT_TOKEN": "123:abc", "ADMIN_ID": 111, "REQUIRED_CHANNELS": "@shop1_news"},
+      {"id": "shop2", "BOT_TOKEN": "456:def", "ADMIN_ID": 222, "SUPPORT_USERNAME": "shop2_help"}
+    ]
+
+    python multi_tenant.py --registry tenants.json --data-dir tenants
+
+يُترجم main.py مرة واحدة ثم يُنفذ في مساحة أسماء مستقلة لكل مستأجر: يتشارك المستأجرون كائنات
+الشيفرة وحلقة الأحداث ومجمعي اتصالات HTTP، بينما تبقى لكل منهم إعداداته وقاعدة بياناته ونسخه
+الاحتياطية في <data-dir>/<id>/ وذاكراته المؤقتة في مساحة أسمائه. الإعدادات غير المذكورة في السجل
+تؤخذ من TENANT_DEFAULTS ثم من متغيرات البيئة.
+
+إعدادات السجلات (LOG_LEVEL و LOG_FORMAT و LOG_QUEUE_SIZE و LOG_DEBUG_SAMPLE_RATE) مشتركة للعملية كلها
+وتُقرأ من متغيرات البيئة فقط؛ وجودها في السجل خطأ.
+"""
+import os
+import re
+import json
+import time
+import types
+import signal
+import asyncio
+import logging
+import argparse
+from collections import ChainMap
+
+from telegram.ext import Application
+from telegram.request import BaseRequest, HTTPXRequest
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+TENANT_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+# إعدادات السجلات تخص العملية كلها (يقرؤها main.py من متغيرات البيئة فقط) لا مستأجراً واحداً
+PROCESS_ONLY_SETTINGS = ('LOG_LEVEL', 'LOG_FORMAT', 'LOG_QUEUE_SIZE', 'LOG_DEBUG_SAMPLE_RATE')
+
+# ذاكرات أصغر لكل مستأجر: مئات البوتات الصغيرة لا تحتاج حجم ذاكرة البوت الواحد
+TENANT_DEFAULTS = {
+    'USER_CACHE_SIZE': '500',
+    'RENDER_CACHE_SIZE': '1000',
+}
+
+# اتصالات مجمع الطلبات العامة المشترك (طلبات الاستطلاع لها مجمع منفصل باتصال لكل مستأجر)
+SHARED_POOL_SIZE = int(os.environ.get("SHARED_POOL_SIZE", "256"))
+
+logger = logging.getLogger(__name__)
+
+# ==============================================================================
+# 1. سجل المستأجرين وتحميلهم
+# ==============================================================================
+
+def load_registry(path):
+    with open(path, encoding='utf-8') as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError("سجل المستأجرين يجب أن يكون قائمة JSON.")
+
+    seen_ids, seen_tokens = set(), set()
+    for entry in entries:
+        tenant_id = str(entry.get('id', ''))
+        if not TENANT_ID_PATTERN.match(tenant_id):
+            raise ValueError(f"معرّف مستأجر غير صالح: {tenant_id!r}")
+        if not entry.get('BOT_TOKEN'):
+            raise ValueError(f"المستأجر {tenant_id} بلا BOT_TOKEN.")
+        process_settings = [key for key in PROCESS_ONLY_SETTINGS if key in entry]
+        if process_settings:
+            raise ValueError(f"المستأجر {tenant_id}: {', '.join(process_settings)} تُضبط لكل العملية عبر متغيرات البيئة لا في السجل.")
+        if tenant_id in seen_ids or entry['BOT_TOKEN'] in seen_tokens:
+            raise ValueError(f"المستأجر {tenant_id} مكرر في السجل (المعرّف أو التوكن).")
+        seen_ids.add(tenant_id)
+        seen_tokens.add(entry['BOT_TOKEN'])
+    return entries
+
+_main_code = None
+
+def _compiled_main():
+    global _main_code
+    if _main_code is None:
+        with open(MAIN_PATH, encoding='utf-8') as f:
+            _main_code = compile(f.read(), MAIN_PATH, 'exec')
+    return _main_code
+
+def load_tenant(entry, data_dir):
+    """تنفيذ main.py في وحدة مستقلة بإعدادات المستأجر وتهيئة قاعدة بياناته."""
+    tenant_id = str(entry['id'])
+    tenant_dir = os.path.join(data_dir, tenant_id)
+    os.makedirs(tenant_dir, exist_ok=True)
+
+    # مسارات البيانات لا تُقرأ من السجل كي لا يشترك مستأجران في قاعدة بيانات واحدة
+    paths = {
+        'DATABASE_NAME': os.path.join(tenant_dir, 'bot_data.db'),
+        'BACKUP_DIR': os.path.join(tenant_dir, 'backups'),
+    }
+    settings = {key: str(value) for key, value in entry.items() if key != 'id'}
+
+    module = types.ModuleType(f"tenant.{tenant_id}")
+    module.__file__ = MAIN_PATH
+    module.TENANT_ID = tenant_id
+    module.TENANT_CONFIG = ChainMap(paths, settings, TENANT_DEFAULTS, os.environ)
+    exec(_compiled_main(), module.__dict__)
+    module.init_db()
+    return module
+
+# ==============================================================================
+# 2. اتصالات HTTP المشتركة
+# ==============================================================================
+
+class SharedRequest(BaseRequest):
+    """مجمع اتصالات HTTP واحد لكل المستأجرين؛ يُغلق فقط عند إيقاف آخر بوت يستخدمه."""
+
+    def __init__(self, request):
+        self._request = request
+        self._users = 0
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        self._users += 1
+        if self._users == 1:
+            await self._request.initialize()
+
+    async def shutdown(self):
+        self._users -= 1
+        if self._users == 0:
+            await self._request.shutdown()
+
+    async def do_request(self, *args, **kwargs):
+        return await self._request.do_request(*args, **kwargs)
+
+def build_tenant_application(module, request, updates_request):
+    builder = Application.builder().token(module.TOKEN).request(request).get_updates_request(updates_request)
+    if module.BOT_API_BASE_URL:
+        builder = builder.base_url(module.BOT_API_BASE_URL)
+    application = builder.build()
+    module.register_handlers(application)
+    return application
+
+# ==============================================================================
+# 3. التشغيل
+# ==============================================================================
+
+async def _start_tenant(module, application):
+    tasks, _ = await module.start_bot(application)
+    return tasks
+
+async def serve_tenants(entries, data_dir):
+    started = time.perf_counter()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    request = SharedRequest(HTTPXRequest(connection_pool_size=SHARED_POOL_SIZE))
+    # كل استطلاع طويل يحجز اتصالاً طوال مدته، لذا اتصال لكل مستأجر
+    updates_request = SharedRequest(HTTPXRequest(connection_pool_size=max(1, len(entries))))
+
+    tenants = []
+    for entry in entries:
+        module = await asyncio.to_thread(load_tenant, entry, data_dir)
+        tenants.append((module, build_tenant_application(module, request, updates_request)))
+
+    results = await asyncio.gather(*(_start_tenant(module, application) for module, application in tenants), return_exceptions=True)
+    running = []
+    for (module, application), result in zip(tenants, results):
+        if isinstance(result, BaseException):
+            # توكن غير صالح أو خطأ شبكة لمستأجر واحد لا يوقف البقية
+            logger.error(f"Tenant {module.TENANT_ID} failed to start: {result!r}")
+            continue
+        running.append((module, application, result))
+
+    rss = running[0][0]._process_rss() if running else None
+    logger.info(
+        f"Multi-tenant startup: tenants={len(running)}/{len(entries)} "
+        f"startup_ms={(time.perf_counter() - started) * 1000:.1f} rss_bytes={rss}"
+    )
+
+    await stop_event.wait()
+
+    metrics = await asyncio.gather(*(module.stop_bot(application, tasks) for module, application, tasks in running))
+    logger.info(
+        f"Multi-tenant shutdown: tenants={len(running)} "
+        f"max_drain_ms={max((m['drain_ms'] for m in metrics), default=0.0):.1f} "
+        f"undrained={sum(1 for m in metrics if not m['drained'])}"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Serve many store bots from one process.")
+    parser.add_argument('--registry', default='tenants.json', help="JSON list of tenant settings")
+    parser.add_argument('--data-dir', default='tenants', help="per-tenant databases and backups live here")
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    # إعداد السجلات (الطابور وخيط الكتابة) يتم مرة واحدة عند تحميل أول مستأجر
+    asyncio.run(serve_tenants(load_registry(args.registry), args.data_dir))